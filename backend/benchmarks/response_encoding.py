@@ -0,0 +1,80 @@
+"""
+量測API回應的序列化時間與壓縮後大小：完整profile與一頁對話歷史
+
+比較標準庫JSONResponse與ORJSONResponse（已安裝orjson時），以及gzip / brotli（已安裝時）壓縮。
+orjson與brotli屬於perf選用依賴，執行方式（在 backend 目錄）:
+    uv sync --extra perf
+    uv run python -m benchmarks.response_encoding --repeat 200
+"""
+
+import argparse
+import json
+import os
+import time
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from compression import CompressionMiddleware, brotli
+
+EXAMPLE_FILE = os.path.join(os.path.dirname(__file__), "..", "data", "users.example.json")
+
+def make_payloads(scale: int):
+    """以範例用戶為樣板放大經歷與專案數，並產生一頁對話歷史"""
+    with open(EXAMPLE_FILE, 'r', encoding='utf-8') as f:
+        profile = next(iter(json.load(f)["users"].values()))["profile_data"]
+    profile["work_experience"] = profile["work_experience"] * scale
+    profile["projects"] = profile["projects"] * scale
+    # 以profile文字輪替產生長短不一的問答內容
+    answer_pool = json.dumps(profile, ensure_ascii=False) * 2
+    history = {
+        "history": [
+            {
+                "index": i,
+                "role": "interviewer" if i % 2 == 0 else "candidate",
+                "content": answer_pool[i % 37:i % 37 + (30 if i % 2 == 0 else 180)],
+                "timestamp": "2025-01-01T12:00:00.000000",
+            }
+            for i in range(200)
+        ],
+        "next": 200,
+        "total": 200,
+        "revision": 200,
+    }
+    return {"profile": profile, "history": history}
+
+def render_ms(response_class, content, repeat: int) -> float:
+    """與FastAPI相同：先jsonable_encoder再由回應類別序列化"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        response_class(jsonable_encoder(content)).body
+    return (time.perf_counter() - started) * 1000 / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=10, help="經歷與專案的放大倍數")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    
+    response_classes = [("json", JSONResponse)]
+    try:
+        import orjson  # noqa: F401
+        from fastapi.responses import ORJSONResponse
+        response_classes.append(("orjson", ORJSONResponse))
+    except ImportError:
+        print("未安裝orjson，略過ORJSONResponse")
+    encodings = ["gzip"] + (["br"] if brotli is not None else [])
+    compressor = CompressionMiddleware(None)
+    
+    for name, content in make_payloads(args.scale).items():
+        body = JSONResponse(jsonable_encoder(content)).body
+        print(f"\n[{name}] 原始大小 {len(body) / 1024:.1f} KiB")
+        for class_name, response_class in response_classes:
+            print(f"  序列化 {class_name:>6}: {render_ms(response_class, content, args.repeat):.3f} ms")
+        for encoding in encodings:
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                compressed = compressor.compress(body, encoding)
+            elapsed = (time.perf_counter() - started) * 1000 / args.repeat
+            print(f"  壓縮 {encoding:>8}: {len(compressed) / 1024:.1f} KiB（{len(compressed) / len(body):.0%}），{elapsed:.3f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+量測每個面試session的記憶體用量：pydantic模型 vs 精簡欄位存放
+
+執行方式（在 backend 目錄）:
+    uv run python -m benchmarks.session_memory --sessions 2000 --turns 10
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+from datetime import datetime
+from models.profile import InterviewMessage, InterviewSession
+from services.session_store import Role, Session
+
+QUESTION = "請談談你在上一份工作中遇到最大的挑戰，以及你是如何解決的？"
+ANSWER = "我在上一份工作中負責資料管線的重構，最大的挑戰是在不中斷服務的情況下完成遷移。" * 4
+
+def build_pydantic(sessions: int, turns: int):
+    result = []
+    for i in range(sessions):
+        session = InterviewSession(session_id=f"s{i}", user_id="1", messages=[], started_at=datetime.now())
+        for _ in range(turns):
+            session.messages.append(InterviewMessage(role="interviewer", content=QUESTION, timestamp=datetime.now()))
+            session.messages.append(InterviewMessage(role="candidate", content=ANSWER, timestamp=datetime.now()))
+        result.append(session)
+    return result
+
+def build_compact(sessions: int, turns: int):
+    result = []
+    for i in range(sessions):
+        session = Session(f"s{i}", "1")
+        for _ in range(turns):
+            session.append(Role.INTERVIEWER, QUESTION)
+            session.append(Role.CANDIDATE, ANSWER)
+        result.append(session)
+    return result
+
+def measure(build, sessions: int, turns: int):
+    """回傳 (每session位元組數, 建立耗時秒數)"""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    data = build(sessions, turns)
+    elapsed = time.perf_counter() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return current / sessions, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--turns", type=int, default=10, help="每個session的問答輪數")
+    args = parser.parse_args()
+    
+    # 訊息內容在實際情況下每則都不同，這裡共用字串，因此只量測容器本身的額外開銷
+    print(f"sessions={args.sessions} turns={args.turns}（內容字串共用，不計入）")
+    for name, build in (("pydantic", build_pydantic), ("compact", build_compact)):
+        per_session, elapsed = measure(build, args.sessions, args.turns)
+        print(f"{name:>9}: {per_session / 1024:8.2f} KiB/session  建立耗時 {elapsed * 1000:8.1f} ms")
+
+if __name__ == "__main__":
+    main()
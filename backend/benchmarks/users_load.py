@@ -0,0 +1,56 @@
+"""
+量測users.json的載入時間與用戶數的關係：完整驗證 vs lazy驗證
+
+lazy驗證搭配orjson（perf選用依賴）解析更快，執行方式（在 backend 目錄）:
+    uv sync --extra perf
+    uv run python -m benchmarks.users_load --counts 100 1000 5000
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from services.user_service import UserService, _json_loads
+
+EXAMPLE_FILE = os.path.join(os.path.dirname(__file__), "..", "data", "users.example.json")
+
+def write_users(path: str, count: int):
+    """以範例用戶為樣板產生指定數量的用戶"""
+    with open(EXAMPLE_FILE, 'r', encoding='utf-8') as f:
+        template = next(iter(json.load(f)["users"].values()))
+    users = {}
+    for i in range(1, count + 1):
+        record = dict(template, id=str(i))
+        users[str(i)] = record
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"users": users}, f, ensure_ascii=False)
+
+def measure(path: str, lazy: bool):
+    """回傳 (啟動耗時ms, 首次get_user耗時ms)"""
+    started = time.perf_counter()
+    service = UserService(path, lazy=lazy)
+    boot = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    service.get_user("1")
+    first = (time.perf_counter() - started) * 1000
+    return boot, first
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[100, 1000, 5000])
+    args = parser.parse_args()
+    
+    parser_name = "orjson" if _json_loads is not json.loads else "json"
+    print(f"JSON解析器: {parser_name}")
+    print(f"{'users':>7} {'eager啟動ms':>12} {'lazy啟動ms':>11} {'lazy首次存取ms':>15}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "users.json")
+        for count in args.counts:
+            write_users(path, count)
+            eager_boot, _ = measure(path, lazy=False)
+            lazy_boot, lazy_first = measure(path, lazy=True)
+            print(f"{count:>7} {eager_boot:>12.1f} {lazy_boot:>11.1f} {lazy_first:>15.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+比較向量儲存精度（float32 / int8）與Matryoshka截斷維度的記憶體、搜尋速度與排序一致性
+
+以完整維度float32的精確搜尋結果為基準。
+執行方式（在 backend 目錄）:
+    uv run python -m benchmarks.vector_quantization --vectors 20000 --dimensions 0 512
+"""
+
+import argparse
+import time
+import numpy as np
+from services.vector_index import STORAGE_DTYPES, VectorIndex
+from benchmarks.vector_search import make_vectors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[0, 512], help="截斷維度，0表示完整維度")
+    args = parser.parse_args()
+    
+    rng = np.random.default_rng(0)
+    data = make_vectors(args.vectors + args.queries, args.dim, rng)
+    vectors, queries = data[:args.vectors], data[args.vectors:]
+    
+    baseline = None
+    print(f"vectors={args.vectors} dim={args.dim} top_k={args.top_k}")
+    print(f"{'mode':>14} {'MiB':>8} {'ms/query':>9} {'recall':>7} {'top1一致':>8}")
+    for dimensions in args.dimensions:
+        for dtype in STORAGE_DTYPES:
+            index = VectorIndex(dtype, dimensions)
+            for i, vector in enumerate(vectors):
+                index.upsert(str(i), vector, "")
+            
+            started = time.perf_counter()
+            results = [[user_id for user_id, _ in index.search(query, args.top_k)] for query in queries]
+            elapsed = (time.perf_counter() - started) * 1000 / len(queries)
+            
+            if baseline is None:
+                baseline = results
+            recall = np.mean([len(set(found) & set(expected)) / len(expected) for found, expected in zip(results, baseline)])
+            top1 = np.mean([found[0] == expected[0] for found, expected in zip(results, baseline)])
+            name = f"{dtype}/{dimensions or args.dim}"
+            print(f"{name:>14} {index.nbytes / 1024 / 1024:>8.1f} {elapsed:>9.3f} {recall:>7.3f} {top1:>8.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+比較精確搜尋與IVF近似搜尋的召回率與延遲
+
+以低維潛在空間投影的隨機向量模擬真實embedding分佈。
+執行方式（在 backend 目錄）:
+    uv run python -m benchmarks.vector_search --vectors 20000 --dim 1536 --nprobe 4 8 16 32
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from services.vector_index import IVFIndex, VectorIndex
+
+def make_vectors(count: int, dim: int, rng: np.random.Generator, latent_dim: int = 16) -> np.ndarray:
+    """由低維潛在空間投影產生向量，近似embedding集中在低維子空間、沒有明確分群的分佈"""
+    latent = rng.standard_normal((count, latent_dim)).astype(np.float32)
+    projection = rng.standard_normal((latent_dim, dim)).astype(np.float32)
+    vectors = latent @ projection + 0.5 * rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def timed_search(index: VectorIndex, queries: np.ndarray, top_k: int):
+    """回傳 (每筆query的結果id集合, 平均延遲ms)"""
+    started = time.perf_counter()
+    results = [{user_id for user_id, _ in index.search(query, top_k)} for query in queries]
+    return results, (time.perf_counter() - started) * 1000 / len(queries)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32])
+    args = parser.parse_args()
+    
+    rng = np.random.default_rng(0)
+    data = make_vectors(args.vectors + args.queries, args.dim, rng)
+    vectors, queries = data[:args.vectors], data[args.vectors:]
+    
+    exact = VectorIndex()
+    ivf = IVFIndex(min_train_size=0)
+    for i, vector in enumerate(vectors):
+        exact.upsert(str(i), vector, "")
+        ivf.upsert(str(i), vector, "")
+    
+    started = time.perf_counter()
+    ivf.train()
+    train_ms = (time.perf_counter() - started) * 1000
+    
+    truth, exact_ms = timed_search(exact, queries, args.top_k)
+    print(f"vectors={args.vectors} dim={args.dim} nlist={len(ivf.centroids)} 訓練耗時 {train_ms:.0f} ms")
+    print(f"{'index':>12} {'ms/query':>9} {f'recall@{args.top_k}':>10}")
+    print(f"{'exact':>12} {exact_ms:>9.3f} {1.0:>10.3f}")
+    for nprobe in args.nprobe:
+        ivf.nprobe = nprobe
+        results, ivf_ms = timed_search(ivf, queries, args.top_k)
+        recall = np.mean([len(found & expected) / len(expected) for found, expected in zip(results, truth)])
+        print(f"{f'ivf/{nprobe}':>12} {ivf_ms:>9.3f} {recall:>10.3f}")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "index.npz")
+        started = time.perf_counter()
+        ivf.save(path, (1, 1))
+        save_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        IVFIndex.load(path, (1, 1))
+        load_ms = (time.perf_counter() - started) * 1000
+        print(f"存檔 {save_ms:.0f} ms，載入 {load_ms:.0f} ms（{os.path.getsize(path) / 1024 / 1024:.1f} MiB）")
+
+if __name__ == "__main__":
+    main()
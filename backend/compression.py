@@ -0,0 +1,93 @@
+"""
+回應壓縮
+超過門檻大小的一般回應依Accept-Encoding以brotli（已安裝時）或gzip壓縮；
+串流回應（NDJSON批次結果、SSE）逐段送出，不壓縮以免被緩衝延遲
+"""
+
+import gzip
+from typing import Optional
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from metrics import metrics
+
+try:
+    import brotli
+except ImportError:  # brotli屬於perf選用依賴，未安裝時只使用gzip
+    brotli = None
+
+# 串流類型：即使整段送出也不壓縮，確保客戶端能即時解析
+EXCLUDED_CONTENT_TYPES = ("text/event-stream", "application/x-ndjson")
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """依Accept-Encoding選擇壓縮格式，優先使用壓縮率較高的brotli"""
+    accepted = set()
+    for part in accept_encoding.replace(" ", "").lower().split(","):
+        name, _, params = part.partition(";")
+        if params not in ("q=0", "q=0.0"):
+            accepted.add(name)
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+class CompressionMiddleware:
+    """只壓縮單段送出的回應；串流、已編碼、過小或304等無內容的回應原樣送出"""
+    
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        start_message: Optional[Message] = None
+        passthrough = False
+        
+        async def send_compressed(message: Message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                start_message = message
+                passthrough = (
+                    "content-encoding" in headers
+                    or headers.get("content-type", "").startswith(EXCLUDED_CONTENT_TYPES)
+                )
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+            
+            start, start_message = start_message, None
+            body = message.get("body", b"")
+            if passthrough or message.get("more_body", False) or len(body) < self.minimum_size:
+                # 串流回應的第一段已決定後續都原樣送出
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+            
+            compressed = self.compress(body, encoding)
+            headers = MutableHeaders(raw=start["headers"])
+            headers.add_vary_header("Accept-Encoding")
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            metrics.inc("compression.bytes_in", len(body))
+            metrics.inc("compression.bytes_out", len(compressed))
+            await send(start)
+            await send({"type": "http.response.body", "body": compressed})
+        
+        await self.app(scope, receive, send_compressed)
+    
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import List, Optional
 import os
 
 class Settings(BaseSettings):
@@ -9,15 +9,117 @@ class Settings(BaseSettings):
     # JSON文件存儲配置
     users_data_file: str = "data/users.json"
     vectors_data_file: str = "data/vectors.json"
+    users_lazy_validation: bool = True  # 啟動時不驗證，各用戶首次存取時才驗證
+    data_reload_interval: float = 2.0  # 輪詢users.json/vectors.json變動的間隔（秒），0表示停用熱更新
+    
+    # 向量索引（用於候選人搜尋）：exact為精確搜尋；ivf為近似最近鄰，適合大量向量
+    vector_index_type: str = "exact"
+    vector_index_file: str = "data/vector_index.npz"  # ivf索引存檔位置
+    ivf_nlist: int = 0  # 分群數，0表示依向量數自動決定（約sqrt(n)）
+    ivf_nprobe: int = 16  # 搜尋時比對的群數，越大召回率越高但越慢
+    ivf_min_train_size: int = 1000  # 向量數少於此值時使用精確搜尋
+    candidate_search_max_results: int = 50  # /api/users/search 單次最多回傳的候選人數
+    vector_storage_dtype: str = "float32"  # float32或int8（量化後記憶體約為1/4）
+    vector_dimensions: int = 0  # 大於0時只保留前N維（Matryoshka截斷），0表示完整維度
+    
+    # 混合檢索：profile段落的BM25關鍵字分數加權進embedding相似度
+    hybrid_retrieval_enabled: bool = True
+    hybrid_keyword_weight: float = 0.3  # 關鍵字分數對相似度的加成比例
+    hybrid_keyword_top_k: int = 3  # 放在context最前面的命中段落數
+    
+    # 檢索策略：小型profile、寒暄、追問與離題問題不執行RAG檢索
+    retrieval_policy_enabled: bool = True
+    retrieval_min_profile_tokens: int = 500  # profile估計token數低於此值時完整資料已在系統提示中，不檢索
     
     # OpenAI 配置
     openai_model: str = "gpt-4.1-mini"
     openai_temperature: float = 0.7
     openai_max_tokens: int = 2000
     
+    # OpenAI 連線配置（所有服務共用同一個連線池）
+    openai_timeout: float = 60.0
+    openai_connect_timeout: float = 5.0
+    openai_max_retries: int = 2
+    openai_pool_max_connections: int = 100
+    openai_pool_max_keepalive: int = 20
+    openai_keepalive_expiry: float = 30.0
+    openai_http2: bool = False  # 需安裝 h2 套件
+    
+    # Embedding 請求合併配置
+    embedding_batch_window_ms: float = 5.0  # 合併並發請求的等待視窗
+    embedding_batch_max_size: int = 64  # 單次embeddings.create的最大文本數
+    
+    # LLM 准入控制
+    llm_max_in_flight: int = 16  # 同時進行中的completion上限
+    llm_tokens_per_minute: int = 0  # 每分鐘token預算，0表示不限制
+    llm_max_queue_size: int = 100  # 排隊上限，超過回傳HTTP 429
+    llm_queue_timeout: float = 30.0  # 排隊等待上限（秒）
+    
+    # 用戶與API key（X-API-Key標頭）的資源隔離：每分鐘token速率與每月token配額，0表示不限制
+    quota_user_tokens_per_minute: int = 0
+    quota_api_key_tokens_per_minute: int = 0
+    quota_user_monthly_tokens: int = 0
+    quota_api_key_monthly_tokens: int = 0
+    quota_api_keys: List[str] = []  # 各自計算額度的API key，其他key共用一組；為空時不套用API key限制
+    quota_db_file: str = "data/usage.sqlite3"  # 每月用量計數
+    quota_flush_interval: float = 5.0  # 用量寫回間隔（秒）
+    
+    # 批次面試：多位候選人 × 多個問題一次送出
+    batch_max_concurrency: int = 8  # 單一批次同時進行的回答生成數
+    batch_max_users: int = 100
+    batch_max_questions: int = 20
+    
+    # 對話歷史查詢：分頁上限、long-poll等待上限與SSE心跳間隔（秒）
+    history_page_max: int = 200
+    history_max_wait: float = 30.0
+    history_stream_heartbeat: float = 15.0
+    
+    # 面試逐字稿：append-only日誌，啟動時重播還原session
+    transcript_log_enabled: bool = True
+    transcript_dir: str = "data/transcripts"
+    transcript_fsync_interval: float = 1.0  # 批次fsync間隔（秒），0表示每次寫入都fsync
+    transcript_replay_days: int = 1  # 啟動時重播今天與前N天的日誌
+    transcript_retention_days: int = 0  # 日誌保存天數，0表示永久保存
+    
+    # 用戶列表單頁上限
+    users_page_max: int = 200
+    
+    # 回應壓縮：超過門檻的一般回應以brotli（已安裝時）或gzip壓縮
+    compression_enabled: bool = True
+    compression_minimum_size: int = 1024  # bytes
+    compression_gzip_level: int = 6
+    compression_brotli_quality: int = 4
+    
+    # 語意答案快取（相同用戶重複的開場問題直接回傳已生成的答案）
+    answer_cache_enabled: bool = False
+    answer_cache_similarity_threshold: float = 0.95
+    answer_cache_ttl_seconds: float = 86400
+    answer_cache_max_entries: int = 10000
+    answer_cache_max_entries_per_user: int = 64
+    
+    # 預生成答案：profile建立/更新時在背景生成自我介紹與常見問題答案
+    canned_answers_enabled: bool = False  # 每次儲存profile會在背景發出數次chat completion，預設關閉
+    canned_answers_file: str = "data/canned_answers.json"
+    canned_answer_similarity_threshold: float = 0.9
+    self_introduction_questions: List[str] = ["請自我介紹", "請先自我介紹一下", "介紹一下你自己"]
+    canned_questions: List[str] = [
+        "你的優勢是什麼",
+        "你的缺點是什麼",
+        "為什麼想應徵這個職位",
+        "你未來的職涯規劃是什麼",
+    ]
+    
     # 預設用戶配置
     default_user_id: str = "1"
     
+    # 啟動配置：預設在首次請求時才建立服務，設為True則在啟動時預先載入
+    preload_services: bool = False
+    
+    # 日誌配置
+    log_level: str = "INFO"
+    log_format: str = "json"  # json 或 text
+    log_debug_sample_rate: float = 0.01  # 高頻DEBUG日誌的抽樣比例
+    
     class Config:
         env_file = ".env"  # 指向當前目錄的.env文件
         case_sensitive = False
@@ -0,0 +1,138 @@
+"""
+結構化日誌設定
+使用 QueueHandler 將日誌寫入移到背景執行緒，避免在請求熱路徑上阻塞 stdout
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+
+from config import settings
+
+# 每個請求的上下文資訊，會自動附加到該請求產生的所有日誌
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+session_id_var: ContextVar[Optional[str]] = ContextVar("session_id", default=None)
+user_id_var: ContextVar[Optional[str]] = ContextVar("user_id", default=None)
+
+# LogRecord 內建屬性，其餘屬性視為透過 extra 傳入的結構化欄位
+_RESERVED_ATTRS = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {
+    "message", "asctime", "request_id", "session_id", "user_id", "sampled"
+}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+class ContextFilter(logging.Filter):
+    """將 request/session/user id 附加到日誌記錄"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        record.session_id = session_id_var.get()
+        record.user_id = user_id_var.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """對標記為 sampled 的高頻 DEBUG 日誌做抽樣，其餘日誌不受影響"""
+    
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or not getattr(record, "sampled", False):
+            return True
+        return self.rate >= 1.0 or random.random() < self.rate
+
+class JsonFormatter(logging.Formatter):
+    """輸出單行 JSON，方便日誌系統收集"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in ("request_id", "session_id", "user_id"):
+            value = getattr(record, key, None)
+            if value is not None:
+                payload[key] = value
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS:
+                payload[key] = value
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """開發用的可讀格式，結構化欄位以 key=value 附在訊息後"""
+    
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(name)s] %(message)s")
+    
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = [
+            f"{key}={getattr(record, key)}"
+            for key in ("request_id", "session_id", "user_id")
+            if getattr(record, key, None) is not None
+        ]
+        fields += [
+            f"{key}={value}"
+            for key, value in record.__dict__.items()
+            if key not in _RESERVED_ATTRS
+        ]
+        return f"{line} {' '.join(fields)}" if fields else line
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    """在呼叫端執行緒擷取上下文，格式化與寫出交給背景執行緒"""
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 只合併 msg/args，不在熱路徑上做完整格式化
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_text = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging() -> None:
+    """設定應用程式日誌（可重複呼叫）"""
+    global _listener
+    if _listener is not None:
+        return
+    
+    root = logging.getLogger("interview")
+    root.setLevel(settings.log_level.upper())
+    root.propagate = False
+    
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter() if settings.log_format == "json" else TextFormatter())
+    
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = _ContextQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(settings.log_debug_sample_rate))
+    queue_handler.addFilter(ContextFilter())
+    root.handlers = [queue_handler]
+    
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+def shutdown_logging() -> None:
+    """停止背景寫出執行緒並送出剩餘日誌"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def get_logger(name: str) -> logging.Logger:
+    """取得應用程式 logger，首次呼叫時自動完成設定"""
+    setup_logging()
+    return logging.getLogger(f"interview.{name}")
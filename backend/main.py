@@ -1,14 +1,99 @@
-from fastapi import FastAPI
+import time
+
+_import_started = time.perf_counter()
+
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from compression import CompressionMiddleware
 from routers import users, interview
 from config import settings
+from logger import get_logger, setup_logging, request_id_var
+from metrics import metrics
+from services.user_service import get_user_service
+from services.embedding_service import get_embedding_service
+from services.llm_service import get_llm_service
+from services.interview_service import get_interview_service
+from services.openai_client import close_openai_client
+from services.quota import api_key_var, get_quota_manager
+from services import hot_reload
+
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except ImportError:  # orjson屬於perf選用依賴，未安裝時使用標準庫的JSONResponse
+    DefaultResponse = JSONResponse
+
+setup_logging()
+logger = get_logger(__name__)
+
+def _reload_if_loaded(factory, method_name: str):
+    """只對已建立的服務做熱更新，尚未建立的服務首次使用時自然會讀到最新檔案"""
+    async def reload() -> bool:
+        if factory.cache_info().currsize == 0:
+            return False
+        return await getattr(factory(), method_name)()
+    return reload
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """啟動時記錄啟動耗時並開始監看資料檔；服務預設在首次請求時才建立，關閉時釋放OpenAI連線池"""
+    report = {"import_ms": round((time.perf_counter() - _import_started) * 1000, 1)}
+    
+    if settings.preload_services:
+        for name, factory in [
+            ("user_service", get_user_service),
+            ("embedding_service", get_embedding_service),
+            ("llm_service", get_llm_service),
+            ("interview_service", get_interview_service),
+        ]:
+            started = time.perf_counter()
+            factory()
+            report[f"{name}_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    
+    report["ready_ms"] = round((time.perf_counter() - _import_started) * 1000, 1)
+    app.state.startup_report = report
+    logger.info("服務啟動完成", extra=report)
+    
+    reload_task = None
+    if settings.data_reload_interval > 0:
+        reload_task = asyncio.create_task(hot_reload.watch([
+            ("users", _reload_if_loaded(get_user_service, "reload_if_changed")),
+            ("vectors", _reload_if_loaded(get_embedding_service, "reload_if_changed")),
+        ], settings.data_reload_interval))
+    
+    yield
+    
+    if reload_task is not None:
+        reload_task.cancel()
+    if get_interview_service.cache_info().currsize:
+        transcript_log = get_interview_service().transcript_log
+        if transcript_log is not None:
+            transcript_log.close()
+    if get_quota_manager.cache_info().currsize:
+        get_quota_manager().close()
+    await close_openai_client()
 
 app = FastAPI(
     title="數位分身面試助手",
     description="Digital Twin Interview Assistant API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=DefaultResponse
 )
 
+# 回應壓縮（串流回應不壓縮）
+if settings.compression_enabled:
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=settings.compression_minimum_size,
+        gzip_level=settings.compression_gzip_level,
+        brotli_quality=settings.compression_brotli_quality,
+    )
+
 # CORS設定
 app.add_middleware(
     CORSMiddleware,
@@ -18,6 +103,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def bind_request_context(request: Request, call_next):
+    """為每個請求綁定request id（附加到日誌與回應標頭）與API key（用於配額）"""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    token = request_id_var.set(request_id)
+    api_key_token = api_key_var.set(request.headers.get("X-API-Key"))
+    try:
+        response = await call_next(request)
+    finally:
+        api_key_var.reset(api_key_token)
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
 # 註冊路由
 app.include_router(users.router)
 app.include_router(interview.router)
@@ -31,8 +130,16 @@ async def root():
     }
 
 @app.get("/health")
-async def health_check():
-    return {"status": "healthy", "service": "interview-api"}
+async def health_check(request: Request):
+    return {
+        "status": "healthy",
+        "service": "interview-api",
+        "startup": getattr(request.app.state, "startup_report", None)
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
 
 if __name__ == "__main__":
     import uvicorn
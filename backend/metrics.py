@@ -0,0 +1,98 @@
+"""
+行程內指標收集
+提供計數器、量測值與延遲分佈，透過 /metrics 端點以JSON輸出
+"""
+
+import threading
+from collections import defaultdict, deque
+from typing import Any, Callable, Deque, Dict
+
+# 每個分佈保留的最近樣本數，用於計算百分位數
+_RESERVOIR_SIZE = 1024
+
+class _Distribution:
+    """累計count/sum/max，並保留最近樣本計算p50/p95/p99"""
+    
+    __slots__ = ("count", "total", "max", "samples")
+    
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples: Deque[float] = deque(maxlen=_RESERVOIR_SIZE)
+    
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.samples.append(value)
+    
+    def summary(self) -> Dict[str, float]:
+        ordered = sorted(self.samples)
+        
+        def percentile(p: float) -> float:
+            if not ordered:
+                return 0.0
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 3)
+        
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+            "max": round(self.max, 3),
+        }
+
+class Metrics:
+    """執行緒安全的指標註冊表"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._gauges: Dict[str, float] = {}
+        self._distributions: Dict[str, _Distribution] = defaultdict(_Distribution)
+        self._collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+    
+    def inc(self, name: str, value: float = 1.0):
+        """累加計數器"""
+        with self._lock:
+            self._counters[name] += value
+    
+    def set_gauge(self, name: str, value: float):
+        """設定量測值"""
+        with self._lock:
+            self._gauges[name] = value
+    
+    def observe(self, name: str, value: float):
+        """記錄一筆分佈樣本（例如延遲毫秒數）"""
+        with self._lock:
+            self._distributions[name].observe(value)
+    
+    def register_collector(self, name: str, collector: Callable[[], Dict[str, Any]]):
+        """註冊在輸出時才計算的指標（例如連線池狀態）"""
+        with self._lock:
+            self._collectors[name] = collector
+    
+    def counter(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0.0)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """輸出所有指標"""
+        with self._lock:
+            result = {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "distributions": {name: d.summary() for name, d in self._distributions.items()},
+            }
+            collectors = dict(self._collectors)
+        for name, collector in collectors.items():
+            try:
+                result[name] = collector()
+            except Exception as e:
+                result[name] = {"error": str(e)}
+        return result
+
+# 全局指標實例
+metrics = Metrics()
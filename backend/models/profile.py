@@ -3,82 +3,84 @@ from typing import List, Optional, Dict, Any
 from datetime import datetime
 
 # 基礎資料模型
+# 欄位的title作為渲染profile文字（embedding、系統提示、關鍵字段落）時的標籤，見 services/profile_renderer.py；
+# json_schema_extra的render為False的欄位（聯絡方式）不會輸出到文字中，unit為數值後加上的單位
 class ContactInfo(BaseModel):
-    name: str = Field(..., min_length=1, max_length=100)
-    email: str = Field(..., pattern=r'^[\w\.-]+@[\w\.-]+\.\w+$')
-    phone: str = Field(..., min_length=10, max_length=20)
-    linkedin: Optional[str] = Field(None, pattern=r'^https://(www\.)?linkedin\.com/.+')  # 支援 www.linkedin.com
-    github: Optional[str] = Field(None, pattern=r'^https://github\.com/.+')
-    location: str
+    name: str = Field(..., min_length=1, max_length=100, title="姓名")
+    email: str = Field(..., pattern=r'^[\w\.-]+@[\w\.-]+\.\w+$', json_schema_extra={"render": False})
+    phone: str = Field(..., min_length=10, max_length=20, json_schema_extra={"render": False})
+    linkedin: Optional[str] = Field(None, pattern=r'^https://(www\.)?linkedin\.com/.+', json_schema_extra={"render": False})  # 支援 www.linkedin.com
+    github: Optional[str] = Field(None, pattern=r'^https://github\.com/.+', json_schema_extra={"render": False})
+    location: str = Field(..., title="位置")
 
 class CareerObjective(BaseModel):
-    target_position: str
-    target_industry: str
-    target_role_types: List[str]
-    preferred_location: str
-    career_goals: str
+    target_position: str = Field(..., title="目標職位")
+    target_industry: str = Field(..., title="目標產業")
+    target_role_types: List[str] = Field(..., title="目標角色類型")
+    preferred_location: str = Field(..., title="偏好地點")
+    career_goals: str = Field(..., title="職業目標")
 
 class Skill(BaseModel):
-    name: str = Field(..., min_length=1)
-    level: int = Field(..., ge=1, le=5)
-    years: float = Field(..., ge=0)
+    name: str = Field(..., min_length=1, title="技能")
+    level: int = Field(..., ge=1, le=5, title="程度", json_schema_extra={"unit": "/5分"})
+    years: float = Field(..., ge=0, title="年資", json_schema_extra={"unit": "年"})
 
 class SkillCategory(BaseModel):
-    """技能分類 - 易於擴展新技能類別"""
-    programming_languages: List[Skill] = []
-    ai_ml_frameworks: List[Skill] = []
-    backend_frameworks: List[Skill] = []
-    databases: List[Skill] = []
-    cloud_devops: List[Skill] = []
-    ai_specialties: List[Skill] = []
-    finance_knowledge: List[Skill] = []
+    """技能分類 - 易於擴展新技能類別（新增欄位並設定title即會出現在embedding與系統提示中）"""
+    programming_languages: List[Skill] = Field([], title="程式語言")
+    ai_ml_frameworks: List[Skill] = Field([], title="AI/ML框架")
+    backend_frameworks: List[Skill] = Field([], title="後端框架")
+    databases: List[Skill] = Field([], title="資料庫")
+    cloud_devops: List[Skill] = Field([], title="雲端/DevOps")
+    ai_specialties: List[Skill] = Field([], title="AI專長")
+    finance_knowledge: List[Skill] = Field([], title="金融知識")
 
 class WorkExperience(BaseModel):
-    company: str
-    position: str
-    duration: str
-    responsibilities: List[str]
-    technologies: List[str]
-    achievements: List[str]
+    company: str = Field(..., title="公司")
+    position: str = Field(..., title="職位")
+    duration: str = Field(..., title="期間")
+    responsibilities: List[str] = Field(..., title="職責")
+    technologies: List[str] = Field(..., title="技術")
+    achievements: List[str] = Field(..., title="成就")
 
 class Project(BaseModel):
-    name: str
-    description: str
-    role: str
-    team_size: int = Field(..., ge=1)
-    duration: str
-    technologies: List[str]
-    challenges: str
-    solutions: str
-    results: str
+    name: str = Field(..., title="專案")
+    description: str = Field(..., title="描述")
+    role: str = Field(..., title="角色")
+    team_size: int = Field(..., ge=1, title="團隊人數")
+    duration: str = Field(..., title="期間")
+    technologies: List[str] = Field(..., title="技術")
+    challenges: str = Field(..., title="挑戰")
+    solutions: str = Field(..., title="解決方案")
+    results: str = Field(..., title="成果")
 
 class Education(BaseModel):
-    degree: str
-    school: str
-    graduation_year: int = Field(..., ge=1950, le=2030)
-    relevant_courses: List[str]
+    degree: str = Field(..., title="學位")
+    school: str = Field(..., title="學校")
+    graduation_year: int = Field(..., ge=1950, le=2030, title="畢業年份")
+    relevant_courses: List[str] = Field(..., title="相關課程")
 
 class Language(BaseModel):
-    language: str
-    level: str
+    language: str = Field(..., title="語言")
+    level: str = Field(..., title="程度")
 
 class Personality(BaseModel):
-    work_style: str
-    values: str
-    interests: List[str]
+    work_style: str = Field(..., title="工作風格")
+    values: str = Field(..., title="價值觀")
+    interests: List[str] = Field(..., title="興趣")
 
 # 聚合履歷資料
 class CompleteProfile(BaseModel):
     """完整履歷檔案"""
-    basic_info: ContactInfo
-    career_objective: CareerObjective
-    work_experience: List[WorkExperience]
-    projects: List[Project]
-    skills: SkillCategory
-    education: List[Education]
-    certifications: List[str]
-    personality: Personality
-    languages: List[Language]
+    basic_info: ContactInfo = Field(..., title="基本資訊")
+    career_objective: CareerObjective = Field(..., title="職業目標")
+    work_experience: List[WorkExperience] = Field(..., title="工作經歷")
+    projects: List[Project] = Field(..., title="專案經歷")
+    skills: SkillCategory = Field(..., title="技能專長")
+    education: List[Education] = Field(..., title="教育背景")
+    certifications: List[str] = Field(..., title="證照")
+    personality: Personality = Field(..., title="個人特質")
+    languages: List[Language] = Field(..., title="語言能力")
 
 class User(BaseModel):
     """用戶實體"""
@@ -113,8 +115,31 @@ class ChatResponse(BaseModel):
     session_id: str
     timestamp: datetime = Field(default_factory=datetime.now)
 
+class BatchInterviewRequest(BaseModel):
+    user_ids: List[str] = Field(..., min_length=1)
+    questions: List[str] = Field(..., min_length=1)
+
+class BatchInterviewResult(BaseModel):
+    """批次面試的單筆結果，以NDJSON逐行回傳"""
+    user_id: str
+    question_index: int
+    question: str
+    response: Optional[str] = None
+    error: Optional[str] = None
+
 class UserListResponse(BaseModel):
     users: List[Dict[str, str]]  # [{"id": "1", "name": "郭懷德"}, ...]
+    total: int = 0
+    next_offset: Optional[int] = None  # 還有下一頁時的offset
+
+class CandidateMatch(BaseModel):
+    id: str
+    name: str
+    similarity: float
+
+class CandidateSearchResponse(BaseModel):
+    query: str
+    results: List[CandidateMatch]  # 依相似度由高到低
 
 class CreateUserRequest(BaseModel):
     profile_data: CompleteProfile
@@ -1,44 +1,258 @@
-from fastapi import APIRouter, HTTPException
-from models.profile import ChatRequest, ChatResponse
-from services.interview_service import interview_service
+import asyncio
+import json
+import math
+from contextlib import aclosing, suppress
+from typing import Any, AsyncIterator, Dict, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from logger import get_logger, session_id_var, user_id_var
+from metrics import metrics
+from models.profile import BatchInterviewRequest, ChatRequest, ChatResponse, User
+from services.admission import AdmissionRejected
+from services.interview_service import InterviewService, get_interview_service
+from services.quota import api_key_var
+from services.session_store import Session
 from config import settings
 
+logger = get_logger(__name__)
+
 router = APIRouter(prefix="/api/interview", tags=["interview"])
 
+# 客戶端已斷線時的狀態碼（沿用nginx的499，實際上不會有人收到）
+CLIENT_CLOSED_REQUEST = 499
+
+async def _cancel_on_disconnect(http_request: Request, task: asyncio.Task):
+    """等待task完成；期間客戶端斷線則取消task（連帶中止上游的LLM呼叫）並回傳None
+    
+    request body已讀取完畢，之後receive()只會在客戶端斷線時回傳http.disconnect
+    """
+    async def wait_for_disconnect():
+        while (await http_request.receive())["type"] != "http.disconnect":
+            pass
+    
+    watcher = asyncio.create_task(wait_for_disconnect())
+    try:
+        done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+    if task in done:
+        return task.result()
+    task.cancel()
+    with suppress(asyncio.CancelledError):
+        await task
+    return None
+
 @router.post("/chat/{user_id}", response_model=ChatResponse)
-async def chat_with_candidate(user_id: str, request: ChatRequest):
-    """與候選人進行面試對話"""
+async def chat_with_candidate(
+    user_id: str,
+    request: ChatRequest,
+    http_request: Request,
+    interview_service: InterviewService = Depends(get_interview_service)
+):
+    """與候選人進行面試對話；客戶端中途斷線時取消生成，不寫入session"""
+    task = asyncio.create_task(interview_service.generate_interview_response(
+        user_id=user_id,
+        message=request.message,
+        session_id=request.session_id
+    ))
     try:
-        result = interview_service.generate_interview_response(
-            user_id=user_id,
-            message=request.message,
-            session_id=request.session_id
-        )
+        result = await _cancel_on_disconnect(http_request, task)
+        if result is None:
+            metrics.inc("interview.chat.client_disconnected")
+            logger.info("客戶端已斷線，取消面試回應")
+            return Response(status_code=CLIENT_CLOSED_REQUEST)
         
         return ChatResponse(
             response=result["response"],
             session_id=result["session_id"],
             timestamp=result["timestamp"]
         )
-        
+    
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"面試對話失敗: {str(e)}")
+    finally:
+        # 伺服器關閉等原因取消此請求時一併取消生成
+        task.cancel()
+
+@router.websocket("/ws/{user_id}")
+async def interview_websocket(
+    websocket: WebSocket,
+    user_id: str,
+    session_id: Optional[str] = None,
+    interview_service: InterviewService = Depends(get_interview_service)
+):
+    """以WebSocket進行面試對話，一個連線對應一個session，回答逐段串流
+    
+    客戶端訊息：{"type": "question", "content": "..."}、{"type": "cancel"}（打斷目前的回答）
+    伺服器訊息：session、token（回答片段）、done（完整回答）、cancelled、error
+    回答中收到新問題時視為打斷，先取消目前的回答再回答新問題
+    """
+    user = interview_service.user_service.get_user(user_id)
+    if user is None:
+        await websocket.close(code=1008, reason=f"用戶 {user_id} 不存在")
+        return
+    await websocket.accept()
+    user_id_var.set(user_id)
+    api_key_var.set(websocket.headers.get("x-api-key"))
+    
+    session = interview_service.get_session(session_id) if session_id else None
+    if session is None:
+        session = interview_service.get_session(interview_service.start_interview(user_id))
+    session_id_var.set(session.session_id)
+    await websocket.send_json({"type": "session", "session_id": session.session_id})
+    
+    answering: Optional[asyncio.Task] = None
+    
+    async def answer(user: User, session: Session, question: str):
+        parts = []
+        try:
+            async with aclosing(interview_service.stream_interview_response(user, session, question)) as stream:
+                async for text in stream:
+                    parts.append(text)
+                    await websocket.send_json({"type": "token", "content": text})
+            await websocket.send_json({"type": "done", "response": "".join(parts)})
+        except AdmissionRejected as e:
+            await websocket.send_json({"type": "error", "status": 429, "detail": str(e), "retry_after": math.ceil(e.retry_after)})
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            logger.error("WebSocket回答失敗", extra={"error": str(e)})
+            with suppress(Exception):
+                await websocket.send_json({"type": "error", "status": 500, "detail": f"面試對話失敗: {str(e)}"})
+    
+    async def interrupt() -> bool:
+        """取消進行中的回答；回傳是否真的有回答被打斷"""
+        if answering is None or answering.done():
+            return False
+        answering.cancel()
+        try:
+            await answering
+        except asyncio.CancelledError:
+            pass
+        metrics.inc("ws.answers_cancelled")
+        return True
+    
+    metrics.inc("ws.connections")
+    try:
+        while True:
+            data = await websocket.receive_json()
+            kind = data.get("type") if isinstance(data, dict) else None
+            if kind == "cancel":
+                if await interrupt():
+                    await websocket.send_json({"type": "cancelled"})
+            elif kind == "question":
+                question = data.get("content")
+                if not isinstance(question, str) or not question.strip():
+                    await websocket.send_json({"type": "error", "status": 400, "detail": "問題不可為空白"})
+                    continue
+                if await interrupt():
+                    await websocket.send_json({"type": "cancelled"})
+                if interview_service.get_session(session.session_id) is None:
+                    # session已被清除，開新的session繼續
+                    session = interview_service.get_session(interview_service.start_interview(user_id))
+                    session_id_var.set(session.session_id)
+                    await websocket.send_json({"type": "session", "session_id": session.session_id})
+                metrics.inc("ws.questions")
+                answering = asyncio.create_task(answer(user, session, question))
+            else:
+                await websocket.send_json({"type": "error", "status": 400, "detail": "未知的訊息類型"})
+    except WebSocketDisconnect:
+        pass
+    except ValueError:
+        # 非JSON訊息
+        await websocket.close(code=1003)
+    finally:
+        # 斷線時中止進行中的回答，上游串流隨之關閉
+        await interrupt()
+
+@router.post("/batch")
+async def batch_interview(request: BatchInterviewRequest, interview_service: InterviewService = Depends(get_interview_service)):
+    """對多位候選人提出同一組問題，結果以NDJSON逐行串流回傳（依完成順序）"""
+    if len(request.user_ids) > settings.batch_max_users:
+        raise HTTPException(status_code=400, detail=f"單次批次最多 {settings.batch_max_users} 位用戶")
+    if len(request.questions) > settings.batch_max_questions:
+        raise HTTPException(status_code=400, detail=f"單次批次最多 {settings.batch_max_questions} 個問題")
+    if any(not question.strip() for question in request.questions):
+        raise HTTPException(status_code=400, detail="問題不可為空白")
+    
+    async def stream() -> AsyncIterator[str]:
+        async for result in interview_service.batch_interview(request.user_ids, request.questions):
+            yield result.model_dump_json() + "\n"
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+def _history_etag(session_id: str, page: Dict[str, Any], after: int, limit: Optional[int]) -> str:
+    return f'W/"{session_id}:{page["revision"]}:{after}:{limit or ""}"'
 
 @router.get("/session/{session_id}/history")
-async def get_conversation_history(session_id: str):
-    """獲取對話歷史"""
+async def get_conversation_history(
+    session_id: str,
+    request: Request,
+    response: Response,
+    after: int = Query(0, ge=0, description="起始訊息索引，傳入上一頁回傳的next即可只取新訊息"),
+    limit: Optional[int] = Query(None, ge=1, le=settings.history_page_max),
+    wait: float = Query(0, ge=0, le=settings.history_max_wait, description="沒有新訊息時最多等待的秒數（long-poll）"),
+    interview_service: InterviewService = Depends(get_interview_service)
+):
+    """獲取對話歷史，支援分頁、ETag與long-poll"""
     try:
-        history = interview_service.get_conversation_history(session_id)
-        if not history:
+        if wait > 0:
+            await interview_service.wait_for_messages(session_id, after, wait)
+        
+        page = interview_service.get_history_page(session_id, after, limit)
+        if page is None:
             raise HTTPException(status_code=404, detail=f"Session {session_id} 不存在")
-        return {"history": history}
+        
+        etag = _history_etag(session_id, page, after, limit)
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+        return page
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"獲取對話歷史失敗: {str(e)}")
 
+@router.get("/session/{session_id}/stream")
+async def stream_conversation_history(
+    session_id: str,
+    request: Request,
+    after: int = Query(0, ge=0, description="起始訊息索引"),
+    interview_service: InterviewService = Depends(get_interview_service)
+):
+    """以Server-Sent Events推送新訊息；重新連線時依Last-Event-ID續傳"""
+    if interview_service.get_session(session_id) is None:
+        raise HTTPException(status_code=404, detail=f"Session {session_id} 不存在")
+    
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        after = int(last_event_id) + 1
+    
+    async def stream() -> AsyncIterator[str]:
+        cursor = after
+        while not await request.is_disconnected():
+            page = interview_service.get_history_page(session_id, cursor)
+            if page is None:
+                yield "event: closed\ndata: {}\n\n"
+                return
+            for message in page["history"]:
+                yield f"id: {message['index']}\nevent: message\ndata: {json.dumps(message, ensure_ascii=False)}\n\n"
+            cursor = page["next"]
+            if not await interview_service.wait_for_messages(session_id, cursor, settings.history_stream_heartbeat):
+                yield ": keepalive\n\n"
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.delete("/session/{session_id}")
-async def clear_session(session_id: str):
+async def clear_session(session_id: str, interview_service: InterviewService = Depends(get_interview_service)):
     """清除面試session"""
     try:
         success = interview_service.clear_session(session_id)
@@ -49,7 +263,7 @@ async def clear_session(session_id: str):
         raise HTTPException(status_code=500, detail=f"清除session失敗: {str(e)}")
 
 @router.post("/start/{user_id}")
-async def start_interview(user_id: str):
+async def start_interview(user_id: str, interview_service: InterviewService = Depends(get_interview_service)):
     """開始面試，返回session_id"""
     try:
         session_id = interview_service.start_interview(user_id)
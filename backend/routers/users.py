@@ -1,46 +1,124 @@
-from fastapi import APIRouter, HTTPException
-from typing import List
-from models.profile import UserListResponse, CompleteProfile, CreateUserRequest, UpdateUserRequest
-from services.user_service import user_service
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request, Response
+from typing import List, Optional
+from config import settings
+from models.profile import (
+    CandidateMatch, CandidateSearchResponse, UserListResponse, CompleteProfile, CreateUserRequest, UpdateUserRequest
+)
+from services.user_service import UserService, get_user_service, project_user
+from services.canned_answer_service import CannedAnswerService, get_canned_answer_service
+from services.embedding_service import EmbeddingService, get_embedding_service
+from services.llm_service import LLMService, get_llm_service
 
 router = APIRouter(prefix="/api/users", tags=["users"])
 
 @router.get("/", response_model=UserListResponse)
-async def get_all_users():
-    """獲取所有用戶列表"""
+async def get_all_users(
+    request: Request,
+    response: Response,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=settings.users_page_max),
+    user_service: UserService = Depends(get_user_service)
+):
+    """獲取用戶列表，支援分頁與ETag"""
     try:
-        users = user_service.get_all_users_list()
-        return UserListResponse(users=users)
+        etag = f'W/"users:{user_service.list_revision}:{offset}:{limit or ""}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        
+        users = user_service.get_all_users_list(offset, limit)
+        total = user_service.count_users()
+        next_offset = offset + len(users)
+        response.headers["ETag"] = etag
+        return UserListResponse(users=users, total=total, next_offset=next_offset if next_offset < total else None)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"獲取用戶列表失敗: {str(e)}")
 
+@router.get("/search", response_model=CandidateSearchResponse)
+async def search_candidates(
+    q: str = Query(..., min_length=1, description="職缺需求或技能描述，例如 熟悉FastAPI的後端工程師"),
+    top_k: int = Query(5, ge=1, le=settings.candidate_search_max_results),
+    user_service: UserService = Depends(get_user_service),
+    embedding_service: EmbeddingService = Depends(get_embedding_service)
+):
+    """依embedding相似度搜尋最符合描述的候選人（VECTOR_INDEX_TYPE=ivf時使用近似搜尋）"""
+    try:
+        results = []
+        for user_id, similarity in await embedding_service.search(q, top_k):
+            # 向量檔可能仍有已刪除用戶的舊向量
+            name = user_service.get_user_name(user_id)
+            if name is not None:
+                results.append(CandidateMatch(id=user_id, name=name, similarity=round(float(similarity), 4)))
+        return CandidateSearchResponse(query=q, results=results)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"搜尋候選人失敗: {str(e)}")
+
 @router.get("/{user_id}")
-async def get_user(user_id: str):
-    """獲取特定用戶詳細資料"""
+async def get_user(
+    user_id: str,
+    request: Request,
+    response: Response,
+    fields: Optional[str] = Query(None, description="只回傳指定的profile欄位，以逗號分隔，例如 basic_info.name,skills"),
+    user_service: UserService = Depends(get_user_service)
+):
+    """獲取特定用戶詳細資料，可用fields只取部分欄位"""
     try:
         user = user_service.get_user(user_id)
         if not user:
             raise HTTPException(status_code=404, detail=f"用戶 {user_id} 不存在")
+        
+        field_list = [field.strip() for field in fields.split(",") if field.strip()] if fields else []
+        etag = f'W/"{user.id}:{user.updated_at.timestamp()}:{",".join(field_list)}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+        
+        if field_list:
+            return project_user(user, field_list)
         return user
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"獲取用戶資料失敗: {str(e)}")
 
 @router.post("/")
-async def create_user(request: CreateUserRequest):
-    """創建新用戶"""
+async def create_user(
+    request: CreateUserRequest,
+    background_tasks: BackgroundTasks,
+    user_service: UserService = Depends(get_user_service),
+    canned_answer_service: CannedAnswerService = Depends(get_canned_answer_service),
+    embedding_service: EmbeddingService = Depends(get_embedding_service)
+):
+    """創建新用戶，並在背景建立向量索引、預生成自我介紹與常見問題答案"""
     try:
         new_user = user_service.create_user(request.profile_data)
+        background_tasks.add_task(canned_answer_service.schedule_precompute, new_user)
+        background_tasks.add_task(embedding_service.update_user_embedding, new_user)
         return new_user
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"創建用戶失敗: {str(e)}")
 
 @router.put("/{user_id}")
-async def update_user(user_id: str, request: UpdateUserRequest):
-    """更新用戶資料"""
+async def update_user(
+    user_id: str,
+    request: UpdateUserRequest,
+    background_tasks: BackgroundTasks,
+    user_service: UserService = Depends(get_user_service),
+    canned_answer_service: CannedAnswerService = Depends(get_canned_answer_service),
+    embedding_service: EmbeddingService = Depends(get_embedding_service),
+    llm_service: LLMService = Depends(get_llm_service)
+):
+    """更新用戶資料，並在背景更新向量索引、重新預生成答案"""
     try:
         updated_user = user_service.update_user(user_id, request.profile_data)
         if not updated_user:
             raise HTTPException(status_code=404, detail=f"用戶 {user_id} 不存在")
+        if llm_service.answer_cache is not None:
+            # 舊版本profile的答案已不會再命中，直接釋放
+            llm_service.answer_cache.invalidate(user_id)
+        background_tasks.add_task(canned_answer_service.schedule_precompute, updated_user)
+        background_tasks.add_task(embedding_service.update_user_embedding, updated_user)
         return updated_user
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新用戶資料失敗: {str(e)}")
@@ -0,0 +1,231 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+from config import settings
+from logger import get_logger
+from metrics import metrics
+
+logger = get_logger(__name__)
+
+# 優先順序：數字越小越先處理
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+class AdmissionRejected(Exception):
+    """佇列已滿或等待逾時，呼叫端應回傳HTTP 429"""
+    
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Ticket:
+    """已取得的LLM呼叫名額，呼叫完成後回報實際token用量"""
+    
+    __slots__ = ("estimated_tokens", "actual_tokens")
+    
+    def __init__(self, estimated_tokens: int):
+        self.estimated_tokens = estimated_tokens
+        self.actual_tokens: Optional[int] = None
+    
+    def record_usage(self, total_tokens: int):
+        self.actual_tokens = total_tokens
+
+class _Waiter:
+    __slots__ = ("future", "tokens", "enqueued_at")
+    
+    def __init__(self, future: asyncio.Future, tokens: int):
+        self.future = future
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+
+class AdmissionController:
+    """LLM呼叫的准入控制
+    
+    - 限制同時進行中的呼叫數
+    - 以token bucket控制每分鐘token用量（預估後依實際用量校正）
+    - 依優先順序排隊，同一優先順序內各session輪流取得名額
+    - 佇列滿時直接拒絕，避免請求無限堆積
+    """
+    
+    def __init__(self, max_in_flight: int, tokens_per_minute: int, max_queue_size: int, queue_timeout: float):
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout
+        self._in_flight = 0
+        self._queued = 0
+        # priority -> session_key -> 等待者
+        self._queues: Dict[int, "OrderedDict[str, Deque[_Waiter]]"] = {}
+        self._tokens = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._retry_handle: Optional[asyncio.TimerHandle] = None
+        # 每次呼叫平均佔用名額的秒數，用於估算Retry-After
+        self._avg_hold_seconds = 5.0
+        metrics.register_collector("admission", self.stats)
+    
+    @asynccontextmanager
+    async def slot(self, session_key: str, estimated_tokens: int, priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[Ticket]:
+        """取得一個LLM呼叫名額，離開時釋放並校正token用量"""
+        await self._acquire(session_key, estimated_tokens, priority)
+        ticket = Ticket(estimated_tokens)
+        started = time.monotonic()
+        try:
+            yield ticket
+        finally:
+            held = time.monotonic() - started
+            self._avg_hold_seconds = 0.9 * self._avg_hold_seconds + 0.1 * held
+            self._release(ticket)
+    
+    async def _acquire(self, session_key: str, tokens: int, priority: int):
+        self._refill()
+        if self._queued == 0 and self._can_admit(tokens):
+            self._admit(tokens)
+            metrics.observe("admission.queue_ms", 0.0)
+            return
+        
+        if self._queued >= self.max_queue_size:
+            metrics.inc("admission.rejected")
+            raise AdmissionRejected("目前請求量過大，請稍後再試", self._retry_after())
+        
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), tokens)
+        sessions = self._queues.setdefault(priority, OrderedDict())
+        sessions.setdefault(session_key, deque()).append(waiter)
+        self._queued += 1
+        
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 名額已分配但呼叫端已放棄，歸還名額
+                self._release(Ticket(tokens))
+            else:
+                waiter.future.cancel()
+                self._remove_waiter(priority, session_key, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.inc("admission.timeouts")
+                raise AdmissionRejected("等待處理逾時，請稍後再試", self._retry_after()) from None
+            raise
+        finally:
+            metrics.observe("admission.queue_ms", (time.monotonic() - waiter.enqueued_at) * 1000)
+    
+    def _remove_waiter(self, priority: int, session_key: str, waiter: _Waiter):
+        sessions = self._queues.get(priority)
+        queue = sessions.get(session_key) if sessions else None
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            self._queued -= 1
+            if not queue:
+                del sessions[session_key]
+    
+    def _can_admit(self, tokens: int) -> bool:
+        if self._in_flight >= self.max_in_flight:
+            return False
+        # 單一請求超過整個bucket時，只要bucket已滿就放行，避免永遠無法執行
+        return self.tokens_per_minute <= 0 or self._tokens >= min(tokens, self.tokens_per_minute)
+    
+    def _admit(self, tokens: int):
+        self._in_flight += 1
+        if self.tokens_per_minute > 0:
+            self._tokens -= tokens
+    
+    def _release(self, ticket: Ticket):
+        self._in_flight -= 1
+        if self.tokens_per_minute > 0 and ticket.actual_tokens is not None:
+            # 依實際用量退回或補扣預估的token
+            self._tokens = min(self.tokens_per_minute, self._tokens + ticket.estimated_tokens - ticket.actual_tokens)
+        self._dispatch()
+    
+    def _refill(self):
+        if self.tokens_per_minute <= 0:
+            return
+        now = time.monotonic()
+        self._tokens = min(
+            self.tokens_per_minute,
+            self._tokens + (now - self._last_refill) * self.tokens_per_minute / 60
+        )
+        self._last_refill = now
+    
+    def _next_waiter(self) -> Optional[_Waiter]:
+        """依優先順序取出下一個等待者，同優先順序內各session輪流"""
+        for priority in sorted(self._queues):
+            sessions = self._queues[priority]
+            while sessions:
+                session_key, queue = next(iter(sessions.items()))
+                if not queue:
+                    del sessions[session_key]
+                    continue
+                return queue[0]
+        return None
+    
+    def _pop_waiter(self, waiter: _Waiter):
+        for sessions in self._queues.values():
+            for session_key, queue in sessions.items():
+                if queue and queue[0] is waiter:
+                    queue.popleft()
+                    self._queued -= 1
+                    if queue:
+                        sessions.move_to_end(session_key)
+                    else:
+                        del sessions[session_key]
+                    return
+    
+    def _dispatch(self):
+        """將空出的名額分配給排隊中的請求"""
+        self._refill()
+        while self._in_flight < self.max_in_flight:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            if not self._can_admit(waiter.tokens):
+                self._schedule_retry(waiter.tokens)
+                return
+            self._pop_waiter(waiter)
+            if waiter.future.done():
+                continue
+            self._admit(waiter.tokens)
+            waiter.future.set_result(None)
+    
+    def _schedule_retry(self, tokens: int):
+        """token不足時，等bucket補足後再分配"""
+        if self._retry_handle is not None:
+            return
+        deficit = min(tokens, self.tokens_per_minute) - self._tokens
+        delay = max(deficit * 60 / self.tokens_per_minute, 0.05)
+        
+        def retry():
+            self._retry_handle = None
+            self._dispatch()
+        
+        self._retry_handle = asyncio.get_running_loop().call_later(delay, retry)
+    
+    def _retry_after(self) -> float:
+        """估算佇列清空所需時間，作為Retry-After秒數"""
+        wait = self._avg_hold_seconds * (self._queued + 1) / max(self.max_in_flight, 1)
+        if self.tokens_per_minute > 0 and self._tokens < 0:
+            wait = max(wait, -self._tokens * 60 / self.tokens_per_minute)
+        return max(1.0, wait)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self._in_flight,
+            "queued": self._queued,
+            "max_in_flight": self.max_in_flight,
+            "tokens_available": round(self._tokens) if self.tokens_per_minute > 0 else None,
+        }
+
+def estimate_tokens(messages, max_completion_tokens: int) -> int:
+    """粗估一次呼叫的token數：中文約每字一個token，加上回應上限"""
+    return sum(len(message["content"]) for message in messages) + max_completion_tokens
+
+@lru_cache
+def get_admission_controller() -> AdmissionController:
+    """取得全局准入控制實例"""
+    return AdmissionController(
+        max_in_flight=settings.llm_max_in_flight,
+        tokens_per_minute=settings.llm_tokens_per_minute,
+        max_queue_size=settings.llm_max_queue_size,
+        queue_timeout=settings.llm_queue_timeout,
+    )
@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import numpy as np
+from metrics import metrics
+
+class _CachedAnswer:
+    __slots__ = ("vector", "answer", "expires_at")
+    
+    def __init__(self, vector: np.ndarray, answer: str, expires_at: float):
+        self.vector = vector
+        self.answer = answer
+        self.expires_at = expires_at
+
+class _UserBucket:
+    """單一用戶、單一profile版本的快取答案"""
+    
+    __slots__ = ("version", "entries", "matrix")
+    
+    def __init__(self, version: str):
+        self.version = version
+        self.entries: List[_CachedAnswer] = []
+        self.matrix: Optional[np.ndarray] = None
+
+class AnswerCache:
+    """語意答案快取：以 用戶id + profile updated_at + 問題embedding 為鍵
+    
+    問題向量與已快取問題的cosine相似度超過閾值即視為同一問題。
+    profile更新後版本改變，舊答案自動失效。
+    """
+    
+    def __init__(self, threshold: float, ttl_seconds: float, max_entries: int, max_entries_per_user: int):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_entries_per_user = max_entries_per_user
+        self._buckets: "OrderedDict[str, _UserBucket]" = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+        metrics.register_collector("answer_cache", self.stats)
+    
+    def lookup(self, user_id: str, version: str, query_vec: np.ndarray) -> Optional[str]:
+        """查詢語意相近的已快取答案，未命中回傳None"""
+        with self._lock:
+            answer = self._lookup(user_id, version, query_vec)
+            if answer is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        metrics.inc("answer_cache.hits" if answer is not None else "answer_cache.misses")
+        return answer
+    
+    def _lookup(self, user_id: str, version: str, query_vec: np.ndarray) -> Optional[str]:
+        bucket = self._buckets.get(user_id)
+        if bucket is None or bucket.version != version:
+            return None
+        self._evict_expired(bucket)
+        if not bucket.entries:
+            return None
+        
+        if bucket.matrix is None:
+            bucket.matrix = np.stack([entry.vector for entry in bucket.entries])
+        scores = bucket.matrix @ query_vec
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        
+        self._buckets.move_to_end(user_id)
+        return bucket.entries[best].answer
+    
+    def store(self, user_id: str, version: str, query_vec: np.ndarray, answer: str):
+        """儲存答案；profile版本改變時丟棄該用戶舊版本的所有答案"""
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None or bucket.version != version:
+                if bucket is not None:
+                    self._size -= len(bucket.entries)
+                bucket = _UserBucket(version)
+                self._buckets[user_id] = bucket
+            self._buckets.move_to_end(user_id)
+            
+            bucket.entries.append(_CachedAnswer(query_vec, answer, time.monotonic() + self.ttl_seconds))
+            bucket.matrix = None
+            self._size += 1
+            if len(bucket.entries) > self.max_entries_per_user:
+                bucket.entries.pop(0)
+                self._size -= 1
+            
+            # 超過總量上限時從最久未使用的用戶開始淘汰
+            while self._size > self.max_entries and self._buckets:
+                oldest_id, oldest = next(iter(self._buckets.items()))
+                if oldest.entries:
+                    oldest.entries.pop(0)
+                    oldest.matrix = None
+                    self._size -= 1
+                if not oldest.entries:
+                    del self._buckets[oldest_id]
+    
+    def invalidate(self, user_id: str):
+        """移除某用戶的所有快取答案"""
+        with self._lock:
+            bucket = self._buckets.pop(user_id, None)
+            if bucket is not None:
+                self._size -= len(bucket.entries)
+    
+    def _evict_expired(self, bucket: _UserBucket):
+        now = time.monotonic()
+        alive = [entry for entry in bucket.entries if entry.expires_at > now]
+        if len(alive) != len(bucket.entries):
+            self._size -= len(bucket.entries) - len(alive)
+            bucket.entries = alive
+            bucket.matrix = None
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "entries": self._size,
+                "users": len(self._buckets),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 3) if total else 0.0,
+            }
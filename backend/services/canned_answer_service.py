@@ -0,0 +1,174 @@
+import asyncio
+import json
+import os
+import re
+from functools import lru_cache, partial
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+from config import settings
+from logger import get_logger
+from metrics import metrics
+from models.profile import User
+from .embedding_service import EmbeddingService, get_embedding_service
+from .admission import PRIORITY_BACKGROUND
+from .llm_service import FALLBACK_RESPONSE, LLMService, get_llm_service
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = get_logger(__name__)
+
+# 比對問題時忽略的標點與空白
+_PUNCTUATION = re.compile(r"[\s，。！？、,.!?：:；;「」\"'（）()]+")
+
+def normalize_question(text: str) -> str:
+    """移除標點與空白並轉小寫，用於問題的精確比對"""
+    return _PUNCTUATION.sub("", text).lower()
+
+class CannedAnswerService:
+    """在profile建立/更新時預先生成自我介紹與常見問題答案，面試第一題可直接從儲存讀取"""
+    
+    def __init__(self, llm_service: LLMService, embedding_service: EmbeddingService, answers_file: str):
+        self.llm_service = llm_service
+        self.embedding_service = embedding_service
+        self.answers_file = answers_file
+        self._store: Dict[str, Dict[str, Any]] = self._load()
+        # 每位用戶的問題向量矩陣，首次比對時才建立
+        self._matrices: Dict[str, Tuple["np.ndarray", List[str]]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+    
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        """從檔案載入預先生成的答案"""
+        try:
+            if os.path.exists(self.answers_file):
+                with open(self.answers_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error("載入預生成答案失敗", extra={"error": str(e)})
+        return {}
+    
+    def _save(self):
+        """儲存預先生成的答案到檔案"""
+        try:
+            os.makedirs(os.path.dirname(self.answers_file) or ".", exist_ok=True)
+            with open(self.answers_file, 'w', encoding='utf-8') as f:
+                json.dump(self._store, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.error("儲存預生成答案失敗", extra={"error": str(e)})
+    
+    def _current_entry(self, user: User) -> Optional[Dict[str, Any]]:
+        """取得與目前profile版本一致的預生成資料，版本過期則視為不存在"""
+        entry = self._store.get(user.id)
+        if entry is None or entry.get("version") != user.updated_at.isoformat():
+            return None
+        return entry
+    
+    async def schedule_precompute(self, user: User):
+        """在背景預生成答案；同一用戶有進行中的任務時先取消舊任務"""
+        if not settings.canned_answers_enabled:
+            return
+        previous = self._tasks.pop(user.id, None)
+        if previous is not None and not previous.done():
+            previous.cancel()
+        task = asyncio.get_running_loop().create_task(self.precompute(user))
+        self._tasks[user.id] = task
+        task.add_done_callback(partial(self._forget_task, user.id))
+    
+    def _forget_task(self, user_id: str, task: asyncio.Task):
+        if self._tasks.get(user_id) is task:
+            del self._tasks[user_id]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("預生成答案失敗", extra={"error": str(task.exception())})
+    
+    async def precompute(self, user: User):
+        """生成並儲存自我介紹與常見問題答案"""
+        version = user.updated_at.isoformat()
+        questions = list(settings.self_introduction_questions) + list(settings.canned_questions)
+        session_key = f"precompute:{user.id}"
+        
+        intro, answers, vectors = await asyncio.gather(
+            self.llm_service.generate_self_introduction(user, session_key=session_key, priority=PRIORITY_BACKGROUND),
+            asyncio.gather(*(
+                self.llm_service.generate_response(user, q, session_key=session_key, priority=PRIORITY_BACKGROUND)
+                for q in settings.canned_questions
+            )),
+            asyncio.gather(*(self.embedding_service.get_query_vector(q) for q in questions)),
+        )
+        
+        # 生成期間profile又被更新時放棄結果，交由新的任務處理
+        if user.updated_at.isoformat() != version:
+            return
+        
+        responses = [intro] * len(settings.self_introduction_questions) + list(answers)
+        entries = [
+            {
+                "question": question,
+                "answer": answer,
+                "embedding": vector.tolist() if vector is not None else [],
+            }
+            for question, answer, vector in zip(questions, responses, vectors)
+            if answer != FALLBACK_RESPONSE
+        ]
+        self._store[user.id] = {
+            "version": version,
+            "self_introduction": intro if intro != FALLBACK_RESPONSE else None,
+            "answers": entries,
+        }
+        self._matrices.pop(user.id, None)
+        self._save()
+        metrics.inc("canned_answers.precomputed")
+        logger.info("預生成答案完成", extra={"answers": len(entries)})
+    
+    async def lookup(
+        self,
+        user: User,
+        message: str,
+        query_vec: Optional["np.ndarray"] = None
+    ) -> Tuple[Optional[str], Optional["np.ndarray"]]:
+        """查詢預生成答案：先精確比對問題文字，再以embedding相似度比對
+        
+        回傳 (答案, 問題向量)；問題向量可交給LLMService重用，避免重複呼叫embedding API。
+        已有問題向量時可直接傳入；功能關閉時不查詢已儲存的答案
+        """
+        if not settings.canned_answers_enabled:
+            return None, query_vec
+        entry = self._current_entry(user)
+        if not entry or not entry["answers"]:
+            return None, query_vec
+        
+        normalized = normalize_question(message)
+        for item in entry["answers"]:
+            if normalize_question(item["question"]) == normalized:
+                metrics.inc("canned_answers.hits")
+                return item["answer"], query_vec
+        
+        if query_vec is None:
+            query_vec = await self.embedding_service.get_query_vector(message)
+        if query_vec is None:
+            return None, query_vec
+        
+        matrix, answers = self._matrix_for(user.id, entry)
+        if not answers:
+            return None, query_vec
+        scores = matrix @ query_vec
+        best = int(scores.argmax())
+        if scores[best] >= settings.canned_answer_similarity_threshold:
+            metrics.inc("canned_answers.hits")
+            return answers[best], query_vec
+        
+        metrics.inc("canned_answers.misses")
+        return None, query_vec
+    
+    def _matrix_for(self, user_id: str, entry: Dict[str, Any]) -> Tuple["np.ndarray", List[str]]:
+        cached = self._matrices.get(user_id)
+        if cached is None:
+            import numpy as np
+            items = [item for item in entry["answers"] if item["embedding"]]
+            matrix = np.array([item["embedding"] for item in items], dtype=np.float32)
+            cached = (matrix, [item["answer"] for item in items])
+            self._matrices[user_id] = cached
+        return cached
+
+@lru_cache
+def get_canned_answer_service() -> CannedAnswerService:
+    """取得全局預生成答案服務實例（首次使用時才建立）"""
+    return CannedAnswerService(get_llm_service(), get_embedding_service(), settings.canned_answers_file)
@@ -1,116 +1,155 @@
-import openai
+import asyncio
 import json
+import logging
 import os
-import numpy as np
-from typing import List, Dict, Any, Tuple
-from sklearn.metrics.pairwise import cosine_similarity
+import time
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Dict, Any, Optional, Set, Tuple
 from config import settings
+from logger import get_logger
+from metrics import metrics
 from models.profile import User
+from .hot_reload import file_signature
+from .keyword_index import KeywordIndex
+from .openai_client import get_openai_client
+from .profile_renderer import get_profile_renderer
+
+if TYPE_CHECKING:
+    import numpy as np
+    from openai import AsyncOpenAI
+    from .vector_index import VectorIndex
+
+logger = get_logger(__name__)
+
+# 批次作業內共用的問題向量（question -> Task），設定後同一問題只在第一次需要時計算一次
+query_vector_memo: ContextVar[Optional[Dict[str, asyncio.Task]]] = ContextVar("query_vector_memo", default=None)
+
+def _consume_exception(future: asyncio.Future):
+    """標記例外已讀取，避免所有等待者都取消時出現未處理例外警告"""
+    if not future.cancelled():
+        future.exception()
 
 class EmbeddingService:
-    def __init__(self):
-        self.client = openai.OpenAI(api_key=settings.openai_api_key)
+    def __init__(self, client: "AsyncOpenAI"):
+        self.client = client
         self.embedding_model = "text-embedding-3-small"
         self.vectors_file = settings.vectors_data_file
+        self._index: Optional["VectorIndex"] = None
+        # 建立索引或寫入時的檔案簽章，用於判斷vectors.json是否被外部修改
+        self._vectors_signature: Optional[Tuple[int, int]] = None
+        # profile段落的BM25索引，各用戶首次檢索或profile更新時建立
+        self.keyword_index = KeywordIndex()
+        # 單一飛行：相同文本的並發請求共用同一個Future
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # 微批次：等待合併送出的文本
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._batch_tasks: Set[asyncio.Task] = set()
+    
+    async def get_embedding(self, text: str) -> List[float]:
+        """獲取文本的embedding向量（相同文本的並發請求只會呼叫一次API）"""
+        if not text.strip():
+            return []
+        
+        metrics.inc("embedding.requests")
+        future = self._inflight.get(text)
+        if future is not None:
+            metrics.inc("embedding.coalesced")
+        else:
+            future = asyncio.get_running_loop().create_future()
+            future.add_done_callback(_consume_exception)
+            self._inflight[text] = future
+            self._pending[text] = future
+            self._schedule_flush()
         
-    def get_embedding(self, text: str) -> List[float]:
-        """獲取文本的embedding向量"""
         try:
-            response = self.client.embeddings.create(
-                input=text,
-                model=self.embedding_model
-            )
-            return response.data[0].embedding
+            # shield: 單一呼叫端取消時不影響其他等待同一結果的請求
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"獲取embedding失敗: {e}")
+            logger.error("獲取embedding失敗", extra={"error": str(e)})
             return []
     
+    def _schedule_flush(self):
+        """累積到批次上限立即送出，否則等待短暫視窗合併其他請求"""
+        if len(self._pending) >= settings.embedding_batch_max_size:
+            self._flush()
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            delay = settings.embedding_batch_window_ms / 1000
+            self._flush_handle = loop.call_later(delay, self._flush) if delay > 0 else loop.call_soon(self._flush)
+    
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        task = asyncio.get_running_loop().create_task(self._embed_batch(batch))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+    
+    async def _embed_batch(self, batch: Dict[str, asyncio.Future]):
+        """將多個文本合併為一次embeddings.create請求"""
+        texts = list(batch)
+        try:
+            try:
+                vectors = await self._create_embeddings(texts)
+            except Exception as e:
+                if len(texts) == 1:
+                    vectors = [e]
+                else:
+                    # 批次失敗時逐筆重試，避免單一無效文本拖累整批
+                    vectors = await asyncio.gather(
+                        *(self._create_embeddings([text]) for text in texts), return_exceptions=True
+                    )
+                    vectors = [v if isinstance(v, Exception) else v[0] for v in vectors]
+            
+            for text, vector in zip(texts, vectors):
+                future = batch[text]
+                if future.done():
+                    continue
+                if isinstance(vector, Exception):
+                    future.set_exception(vector)
+                else:
+                    future.set_result(vector)
+        finally:
+            # 回應筆數少於輸入或批次被取消（例如關閉服務）時，未完成的等待者改收到錯誤，不會永遠等待
+            for text in texts:
+                self._inflight.pop(text, None)
+                future = batch[text]
+                if not future.done():
+                    future.set_exception(RuntimeError("embedding回應缺少此文本的結果"))
+    
+    async def _create_embeddings(self, texts: List[str]) -> List[List[float]]:
+        started = time.perf_counter()
+        metrics.observe("embedding.batch_size", len(texts))
+        try:
+            response = await self.client.embeddings.create(
+                input=texts,
+                model=self.embedding_model
+            )
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except Exception:
+            metrics.inc("openai.embedding.errors")
+            raise
+        finally:
+            metrics.observe("openai.embedding.latency_ms", (time.perf_counter() - started) * 1000)
+    
     def extract_user_profile_text(self, user: User) -> str:
         """將用戶資料轉換為文本用於embedding"""
-        profile = user.profile_data
-        
-        # 組合所有相關文本
-        text_parts = []
-        
-        # 基本資訊
-        text_parts.append(f"姓名：{profile.basic_info.name}")
-        text_parts.append(f"位置：{profile.basic_info.location}")
-        
-        # 職業目標
-        text_parts.append(f"目標職位：{profile.career_objective.target_position}")
-        text_parts.append(f"目標產業：{profile.career_objective.target_industry}")
-        text_parts.append(f"職業目標：{profile.career_objective.career_goals}")
-        text_parts.append(f"目標角色類型：{', '.join(profile.career_objective.target_role_types)}")
-        
-        # 工作經歷
-        for exp in profile.work_experience:
-            text_parts.append(f"工作經歷：{exp.company} {exp.position}")
-            text_parts.append(f"職責：{' '.join(exp.responsibilities)}")
-            text_parts.append(f"技術：{' '.join(exp.technologies)}")
-            text_parts.append(f"成就：{' '.join(exp.achievements)}")
-        
-        # 專案經歷
-        for proj in profile.projects:
-            text_parts.append(f"專案：{proj.name}")
-            text_parts.append(f"專案描述：{proj.description}")
-            text_parts.append(f"角色：{proj.role}")
-            text_parts.append(f"技術：{' '.join(proj.technologies)}")
-            text_parts.append(f"挑戰：{proj.challenges}")
-            text_parts.append(f"解決方案：{proj.solutions}")
-            text_parts.append(f"成果：{proj.results}")
-        
-        # 技能
-        all_skills = []
-        for skill_category in [
-            profile.skills.programming_languages,
-            profile.skills.ai_ml_frameworks,
-            profile.skills.backend_frameworks,
-            profile.skills.databases
-        ]:
-            for skill in skill_category:
-                all_skills.append(f"{skill.name} {skill.level}級 {skill.years}年經驗")
-        
-        # 檢查是否有frontend_frameworks
-        if hasattr(profile.skills, 'frontend_frameworks'):
-            for skill in profile.skills.frontend_frameworks:
-                all_skills.append(f"{skill.name} {skill.level}級 {skill.years}年經驗")
-        
-        # 檢查是否有version_control
-        if hasattr(profile.skills, 'version_control'):
-            for skill in profile.skills.version_control:
-                all_skills.append(f"{skill.name} {skill.level}級 {skill.years}年經驗")
-        
-        # 檢查是否有ai_specialties
-        if hasattr(profile.skills, 'ai_specialties'):
-            for skill in profile.skills.ai_specialties:
-                all_skills.append(f"{skill.name} {skill.level}級 {skill.years}年經驗")
-        
-        text_parts.append(f"技能：{' '.join(all_skills)}")
-        
-        # 教育背景
-        for edu in profile.education:
-            text_parts.append(f"教育：{edu.degree} {edu.school}")
-            if hasattr(edu, 'relevant_courses'):
-                text_parts.append(f"相關課程：{' '.join(edu.relevant_courses)}")
-        
-        # 證照
-        if profile.certifications:
-            text_parts.append(f"證照：{' '.join(profile.certifications)}")
-        
-        # 個人特質
-        text_parts.append(f"工作風格：{profile.personality.work_style}")
-        text_parts.append(f"價值觀：{profile.personality.values}")
-        text_parts.append(f"興趣：{' '.join(profile.personality.interests)}")
-        
-        # 語言能力
-        text_parts.append(f"語言：{' '.join([f'{lang.language} {lang.level}' for lang in profile.languages])}")
-        
-        return " ".join(text_parts)
+        return get_profile_renderer().render(user).text
     
-    def create_user_embedding(self, user: User) -> Dict[str, Any]:
-        """為用戶創建embedding"""
+    async def create_user_embedding(self, user: User) -> Dict[str, Any]:
+        """為用戶創建embedding（儲存前先正規化）"""
         profile_text = self.extract_user_profile_text(user)
-        embedding = self.get_embedding(profile_text)
+        embedding = await self.get_embedding(profile_text)
+        if embedding:
+            from .vector_index import normalize_vector
+            embedding = normalize_vector(embedding).tolist()
         
         return {
             "user_id": user.id,
@@ -126,8 +165,9 @@ class EmbeddingService:
             os.makedirs(os.path.dirname(self.vectors_file), exist_ok=True)
             with open(self.vectors_file, 'w', encoding='utf-8') as f:
                 json.dump(embeddings, f, ensure_ascii=False, indent=2, default=str)
+            self._vectors_signature = file_signature(self.vectors_file)
         except Exception as e:
-            print(f"保存embeddings失敗: {e}")
+            logger.error("保存embeddings失敗", extra={"error": str(e)})
     
     def load_embeddings(self) -> Dict[str, Any]:
         """從檔案載入embeddings"""
@@ -136,73 +176,237 @@ class EmbeddingService:
                 with open(self.vectors_file, 'r', encoding='utf-8') as f:
                     return json.load(f)
         except Exception as e:
-            print(f"載入embeddings失敗: {e}")
+            logger.error("載入embeddings失敗", extra={"error": str(e)})
         return {}
     
-    def update_user_embedding(self, user: User):
+    def _new_index(self) -> "VectorIndex":
+        """依設定建立精確索引或IVF近似索引"""
+        from .vector_index import IVFIndex, VectorIndex
+        if settings.vector_index_type == "ivf":
+            return IVFIndex(
+                settings.ivf_nlist,
+                settings.ivf_nprobe,
+                settings.ivf_min_train_size,
+                settings.vector_storage_dtype,
+                settings.vector_dimensions
+            )
+        return VectorIndex(settings.vector_storage_dtype, settings.vector_dimensions)
+    
+    def _persist_index(self, index: "VectorIndex"):
+        """IVF索引存檔，下次啟動時若vectors.json未變動可直接載入，不需重新訓練"""
+        from .vector_index import IVFIndex
+        if isinstance(index, IVFIndex) and index.trained:
+            try:
+                index.save(settings.vector_index_file, self._vectors_signature)
+            except Exception as e:
+                logger.error("儲存向量索引失敗", extra={"error": str(e)})
+    
+    @property
+    def index(self) -> "VectorIndex":
+        """首次使用時從檔案建立向量索引，之後直接使用記憶體中的矩陣"""
+        if self._index is None:
+            from .vector_index import IVFIndex
+            self._vectors_signature = file_signature(self.vectors_file)
+            index = None
+            if settings.vector_index_type == "ivf":
+                index = IVFIndex.load(
+                    settings.vector_index_file,
+                    self._vectors_signature,
+                    settings.ivf_nlist,
+                    settings.ivf_nprobe,
+                    settings.ivf_min_train_size,
+                    settings.vector_storage_dtype,
+                    settings.vector_dimensions
+                )
+            if index is None:
+                index = self._new_index()
+                for user_id, record in self.load_embeddings().items():
+                    if record.get("embedding"):
+                        index.upsert(user_id, record["embedding"], record.get("profile_text", ""))
+                if isinstance(index, IVFIndex) and index.maybe_train():
+                    self._persist_index(index)
+            self._index = index
+        return self._index
+    
+    async def reload_if_changed(self) -> bool:
+        """vectors.json被外部修改時（例如重新執行init_embeddings.py），只更新有變動的向量
+        
+        在索引副本上更新後整體替換，搜尋中的請求仍使用舊索引。回傳是否有變動
+        """
+        signature = file_signature(self.vectors_file)
+        if signature is None or signature == self._vectors_signature:
+            return False
+        if self._index is None:
+            # 索引尚未建立，首次使用時會直接讀取新檔案
+            return False
+        
+        records = await asyncio.to_thread(self.load_embeddings)
+        if file_signature(self.vectors_file) != signature:
+            return False
+        self._vectors_signature = signature
+        
+        current = self._index
+        changed = [
+            user_id for user_id, record in records.items()
+            if record.get("embedding") and (
+                user_id not in current.positions or current.texts.get(user_id) != record.get("profile_text", "")
+            )
+        ]
+        removed = [user_id for user_id in current.ids if not records.get(user_id, {}).get("embedding")]
+        if not changed and not removed:
+            return False
+        
+        index = current.copy()
+        for user_id in removed:
+            index.remove(user_id)
+        for user_id in changed:
+            index.upsert(user_id, records[user_id]["embedding"], records[user_id].get("profile_text", ""))
+        await self._maybe_retrain(index)
+        if self._vectors_signature != signature:
+            # 重新訓練期間有用戶更新向量，放棄此次結果並在下次輪詢重新載入
+            self._vectors_signature = None
+            return False
+        self._index = index
+        self._persist_index(index)
+        logger.info("vectors.json已重新載入", extra={"changed": changed, "removed": removed})
+        return True
+    
+    async def update_user_embedding(self, user: User):
         """更新用戶的embedding"""
+        user_embedding = await self.create_user_embedding(user)
         embeddings = self.load_embeddings()
-        user_embedding = self.create_user_embedding(user)
         embeddings[user.id] = user_embedding
         self.save_embeddings(embeddings)
+        self.keyword_index.ensure_user(user)
+        if user_embedding["embedding"]:
+            # IVF索引會將新向量直接分配到最近的群，不需重新訓練
+            self.index.upsert(user.id, user_embedding["embedding"], user_embedding["profile_text"])
+            self._persist_index(self.index)
     
-    def calculate_similarity(self, query: str, user_id: str) -> Tuple[float, str]:
-        """計算query與用戶資料的相似度"""
+    async def _maybe_retrain(self, index: "VectorIndex"):
+        """IVF索引資料量大幅成長時在背景執行緒重新訓練"""
+        from .vector_index import IVFIndex
+        if isinstance(index, IVFIndex) and index.needs_training():
+            await asyncio.to_thread(index.train)
+    
+    async def get_query_vector(self, query: str) -> Optional["np.ndarray"]:
+        """獲取query的正規化embedding向量
+        
+        目前context設有query_vector_memo時，同一query的向量由共用該快取的協程重用
+        """
+        memo = query_vector_memo.get()
+        if memo is None:
+            return await self._compute_query_vector(query)
+        task = memo.get(query)
+        if task is None:
+            task = memo[query] = asyncio.ensure_future(self._compute_query_vector(query))
+            task.add_done_callback(_consume_exception)
+        # 單一等待者被取消時不中止其他協程共用的計算
+        return await asyncio.shield(task)
+    
+    async def _compute_query_vector(self, query: str) -> Optional["np.ndarray"]:
+        from .vector_index import normalize_vector
+        query_embedding = await self.get_embedding(query)
+        if not query_embedding:
+            return None
+        return normalize_vector(query_embedding)
+    
+    async def calculate_similarity(self, query: str, user_id: str, query_vec: Optional["np.ndarray"] = None) -> Tuple[float, str]:
+        """計算query與用戶資料的相似度（可傳入已計算的query向量）"""
         try:
-            # 獲取query的embedding
-            query_embedding = self.get_embedding(query)
-            if not query_embedding:
+            if query_vec is None:
+                query_vec = await self.get_query_vector(query)
+            if query_vec is None:
                 return 0.0, ""
             
-            # 載入用戶embeddings
-            embeddings = self.load_embeddings()
-            if user_id not in embeddings:
+            index = self.index
+            if user_id not in index.positions:
                 return 0.0, ""
             
-            user_embedding = embeddings[user_id]["embedding"]
-            if not user_embedding:
-                return 0.0, ""
-            
-            # 計算cosine similarity
-            query_vec = np.array(query_embedding).reshape(1, -1)
-            user_vec = np.array(user_embedding).reshape(1, -1)
-            similarity = cosine_similarity(query_vec, user_vec)[0][0]
-            
-            # 獲取相關的profile文本
-            relevant_profile = embeddings[user_id]["profile_text"]
-            
-            return similarity, relevant_profile
-            
+            return index.score(query_vec, user_id), index.texts[user_id]
+        
         except Exception as e:
-            print(f"計算相似度失敗: {e}")
+            logger.error("計算相似度失敗", extra={"error": str(e)})
             return 0.0, ""
     
-    def get_relevant_profile_context(self, query: str, user_id: str, threshold: float = 0.3) -> str:
-        """根據query獲取相關的profile context"""
-        print(f"🔍 RAG檢索開始 - 問題: '{query}' (用戶: {user_id})")
+    async def search(self, query: str, top_k: int = 5) -> List[Tuple[str, float]]:
+        """搜尋與query最相似的用戶，回傳(user_id, 相似度)列表"""
+        try:
+            query_vec = await self.get_query_vector(query)
+            if query_vec is None:
+                return []
+            return self.index.search(query_vec, top_k)
+        except Exception as e:
+            logger.error("向量搜尋失敗", extra={"error": str(e)})
+            return []
+    
+    async def get_relevant_profile_context(
+        self,
+        query: str,
+        user_id: str,
+        threshold: float = 0.3,
+        query_vec: Optional["np.ndarray"] = None,
+        user: Optional[User] = None
+    ) -> str:
+        """根據query獲取相關的profile context
         
-        similarity, profile_text = self.calculate_similarity(query, user_id)
+        傳入user時以關鍵字索引輔助：query中的技術名稱全部命中該用戶的profile時直接採用RAG，
+        不呼叫embedding API；否則BM25分數會加成embedding相似度，並把命中的段落放在最前面
+        """
+        hits: List[Tuple[str, float]] = []
+        keyword_score = 0.0
+        if user is not None and settings.hybrid_retrieval_enabled:
+            self.keyword_index.ensure_user(user)
+            hits, coverage = self.keyword_index.search(query, user_id, settings.hybrid_keyword_top_k)
+            if hits:
+                # BM25分數無上限，壓到0~1之間再與相似度結合
+                keyword_score = hits[0][1] / (hits[0][1] + 3.0)
+            if coverage == 1.0 and query_vec is None and user_id in self.index.positions:
+                metrics.inc("retrieval.embedding_skipped")
+                logger.info("RAG檢索完成", extra={"keyword_score": round(keyword_score, 3), "use_rag": True, "embedding_skipped": True})
+                return self._format_profile_context(f"關鍵字完全命中，關鍵字分數: {keyword_score:.3f}", self.index.texts[user_id], hits)
         
-        print(f"📊 相似度計算結果: {similarity:.3f}")
+        similarity, profile_text = await self.calculate_similarity(query, user_id, query_vec)
+        # 關鍵字只會提高分數：無命中時與純embedding相似度相同
+        score = similarity + settings.hybrid_keyword_weight * keyword_score * (1 - similarity)
+        use_rag = score > threshold
+        if use_rag and hits and similarity <= threshold:
+            metrics.inc("retrieval.keyword_promoted")
         
-        if similarity > threshold:
-            print(f"✅ 相似度超過閾值 ({threshold})，使用RAG增強")
-            print(f"📄 檢索到的相關內容預覽: {profile_text[:200]}..." if len(profile_text) > 200 else f"📄 檢索到的完整內容: {profile_text}")
-            
+        logger.info("RAG檢索完成", extra={
+            "similarity": round(float(similarity), 3),
+            "keyword_score": round(keyword_score, 3),
+            "score": round(float(score), 3),
+            "threshold": threshold,
+            "use_rag": use_rag
+        })
+        
+        if use_rag:
+            return self._format_profile_context(f"相似度: {similarity:.3f}，綜合分數: {score:.3f}", profile_text, hits)
+        else:
             return f"""
-基於問題相關度分析（相似度: {similarity:.3f}），以下是最相關的個人資料：
-
-{profile_text}
+問題相關度分析（相似度: {similarity:.3f}）：此問題與現有資料關聯較低，將基於一般資料回答。
 
 ---
 """
-        else:
-            print(f"⚠️ 相似度低於閾值 ({threshold})，使用通用回答模式")
-            return f"""
-問題相關度分析（相似度: {similarity:.3f}）：此問題與現有資料關聯較低，將基於一般資料回答。
+    
+    def _format_profile_context(self, summary: str, profile_text: str, hits: List[Tuple[str, float]]) -> str:
+        """組合RAG context，關鍵字命中的段落放在完整資料之前"""
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("RAG檢索內容預覽", extra={"preview": profile_text[:200], "sampled": True})
+        
+        matched = ""
+        if hits:
+            matched = "與問題最相關的段落：\n" + "\n".join(f"- {text}" for text, _ in hits) + "\n\n"
+        return f"""
+基於問題相關度分析（{summary}），以下是最相關的個人資料：
+
+{matched}{profile_text}
 
 ---
 """
 
-# 全局embedding服務實例
-embedding_service = EmbeddingService()
+@lru_cache
+def get_embedding_service() -> EmbeddingService:
+    """取得全局embedding服務實例（首次使用時才建立）"""
+    return EmbeddingService(get_openai_client())
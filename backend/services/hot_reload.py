@@ -0,0 +1,34 @@
+"""
+資料檔熱更新
+以mtime輪詢監看users.json與vectors.json，檔案被外部修改時讓執行中的服務重新載入，不需重啟
+"""
+
+import asyncio
+import os
+from typing import Awaitable, Callable, List, Optional, Tuple
+from logger import get_logger
+from metrics import metrics
+
+logger = get_logger(__name__)
+
+def file_signature(path: str) -> Optional[Tuple[int, int]]:
+    """以 (mtime_ns, size) 判斷檔案是否變動；檔案不存在時回傳None"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+async def watch(reloaders: List[Tuple[str, Callable[[], Awaitable[bool]]]], interval: float):
+    """定期呼叫各服務的重新載入函式（由各服務自行比對檔案簽章），直到被取消"""
+    while True:
+        await asyncio.sleep(interval)
+        for name, reload in reloaders:
+            try:
+                if await reload():
+                    metrics.inc(f"hot_reload.{name}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                metrics.inc("hot_reload.errors")
+                logger.error("重新載入資料失敗", extra={"source": name, "error": str(e)})
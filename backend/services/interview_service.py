@@ -1,97 +1,168 @@
-from typing import Dict, List, Optional
+import asyncio
+import time
+from contextlib import aclosing
+from functools import lru_cache
+from typing import AsyncIterator, Dict, List, Optional
 from datetime import datetime
 import uuid
-from models.profile import InterviewSession, InterviewMessage
-from services.user_service import user_service
-from services.llm_service import llm_service
+from logger import get_logger, session_id_var, user_id_var
+from models.profile import BatchInterviewResult, User
+from config import settings
+from services.admission import PRIORITY_BACKGROUND
+from services.user_service import UserService, get_user_service
+from services.llm_service import LLMService, get_llm_service
+from services.canned_answer_service import CannedAnswerService, get_canned_answer_service
+from services.embedding_service import query_vector_memo
+from services.session_store import ROLE_NAMES, Role, Session, parse_role
+from services.transcript_log import TranscriptLog
+
+logger = get_logger(__name__)
 
 class InterviewService:
-    def __init__(self):
-        # 使用記憶體存儲對話session (不持久化)
-        self.sessions: Dict[str, InterviewSession] = {}
+    def __init__(
+        self,
+        user_service: UserService,
+        llm_service: LLMService,
+        canned_answer_service: CannedAnswerService,
+        transcript_log: Optional[TranscriptLog] = None
+    ):
+        self.user_service = user_service
+        self.llm_service = llm_service
+        self.canned_answer_service = canned_answer_service
+        # 對話session存在記憶體中；啟用逐字稿日誌時每次增刪都寫入日誌，啟動時重播還原
+        self.transcript_log = transcript_log
+        self.sessions: Dict[str, Session] = transcript_log.replay() if transcript_log is not None else {}
+        # 每個session一把鎖，確保同一session的訊息依序處理
+        self._session_locks: Dict[str, asyncio.Lock] = {}
+        # 等待新訊息的long-poll/SSE請求，session有變動時喚醒
+        self._session_events: Dict[str, asyncio.Event] = {}
     
     def start_interview(self, user_id: str) -> str:
         """開始面試，返回session_id"""
-        user = user_service.get_user(user_id)
+        user = self.user_service.get_user(user_id)
         if not user:
             raise ValueError(f"用戶 {user_id} 不存在")
         
         session_id = str(uuid.uuid4())
-        session = InterviewSession(
-            session_id=session_id,
-            user_id=user_id,
-            messages=[],
-            started_at=datetime.now()
-        )
-        
-        self.sessions[session_id] = session
+        session = self.sessions[session_id] = Session(session_id, user_id)
+        if self.transcript_log is not None:
+            self.transcript_log.log_start(session)
         return session_id
     
-    def get_session(self, session_id: str) -> Optional[InterviewSession]:
+    def get_session(self, session_id: str) -> Optional[Session]:
         """獲取面試session"""
         return self.sessions.get(session_id)
     
     def add_message(self, session_id: str, role: str, content: str) -> bool:
         """加入訊息到session"""
         session = self.sessions.get(session_id)
-        if not session:
+        if session is None:
             return False
         
-        message = InterviewMessage(
-            role=role,
-            content=content,
-            timestamp=datetime.now()
-        )
-        session.messages.append(message)
+        self._append(session, parse_role(role), content)
         return True
     
-    def generate_interview_response(self, user_id: str, message: str, session_id: Optional[str] = None) -> Dict:
+    def _append(self, session: Session, role: Role, content: str):
+        """加入訊息、寫入逐字稿日誌並喚醒等待中的請求"""
+        timestamp = time.time()
+        session.append(role, content, timestamp)
+        if self.transcript_log is not None:
+            self.transcript_log.log_message(session.session_id, role, content, timestamp)
+        self._notify(session.session_id)
+    
+    def _pop(self, session: Session):
+        """移除最後一則訊息"""
+        session.pop()
+        if self.transcript_log is not None:
+            self.transcript_log.log_pop(session.session_id)
+        self._notify(session.session_id)
+    
+    def _session_lock(self, session_id: str) -> asyncio.Lock:
+        """取得session的鎖（首次使用時建立）"""
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = self._session_locks[session_id] = asyncio.Lock()
+        return lock
+    
+    def _notify(self, session_id: str):
+        """喚醒等待此session新訊息的請求"""
+        event = self._session_events.pop(session_id, None)
+        if event is not None:
+            event.set()
+    
+    async def wait_for_messages(self, session_id: str, after: int, timeout: float) -> bool:
+        """等待session出現索引after（含）之後的訊息；逾時或session已清除時回傳False"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            session = self.get_session(session_id)
+            if session is None:
+                return False
+            if len(session) > after:
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            event = self._session_events.setdefault(session_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+    
+    async def generate_interview_response(self, user_id: str, message: str, session_id: Optional[str] = None) -> Dict:
         """生成面試回應"""
-        print(f"🎯 開始處理面試問題 - 用戶ID: {user_id}, 問題: '{message}'")
+        user_id_var.set(user_id)
         
         # 獲取用戶資料
-        user = user_service.get_user(user_id)
+        user = self.user_service.get_user(user_id)
         if not user:
             raise ValueError(f"用戶 {user_id} 不存在")
         
-        print(f"👤 用戶資料已載入: {user.profile_data.basic_info.name}")
-        
         # 處理session
         if not session_id:
             session_id = self.start_interview(user_id)
-            print(f"🆕 創建新的面試session: {session_id}")
+            logger.info("創建新的面試session", extra={"new_session_id": session_id})
         
         session = self.get_session(session_id)
-        if not session:
+        if session is None:
             session_id = self.start_interview(user_id)
             session = self.get_session(session_id)
-            print(f"🔄 重建面試session: {session_id}")
-        
-        # 加入面試官問題
-        self.add_message(session_id, "interviewer", message)
-        print(f"📝 面試官問題已記錄")
-        
-        # 準備對話歷史給LLM
-        conversation_history = []
-        for msg in session.messages[:-1]:  # 排除剛加入的當前問題
-            role = "user" if msg.role == "interviewer" else "assistant"
-            conversation_history.append({
-                "role": role,
-                "content": msg.content
-            })
-        
-        print(f"📋 對話歷史準備完成: {len(conversation_history)} 條記錄")
-        
-        # 生成回應
-        response = llm_service.generate_response(
-            user=user,
-            message=message,
-            conversation_history=conversation_history
-        )
+            logger.info("重建面試session", extra={"new_session_id": session_id})
+        
+        session_id_var.set(session_id)
         
-        # 加入AI回應
-        self.add_message(session_id, "candidate", response)
-        print(f"💾 AI回應已保存到session")
+        # 同一session的訊息依序處理（問題與回答成對寫入），不同session之間可並行
+        async with self._session_lock(session_id):
+            # 準備對話歷史給LLM（不含目前問題）
+            conversation_history = session.to_llm_history()
+            
+            # 加入面試官問題
+            self._append(session, Role.INTERVIEWER, message)
+            
+            try:
+                # 第一題優先使用預生成答案
+                response, query_vec = None, None
+                if not conversation_history:
+                    response, query_vec = await self.canned_answer_service.lookup(user, message)
+                    if response is not None:
+                        logger.info("使用預生成答案")
+                
+                # 生成回應
+                if response is None:
+                    response = await self.llm_service.generate_response(
+                        user=user,
+                        message=message,
+                        conversation_history=conversation_history,
+                        query_vec=query_vec,
+                        session_key=session_id
+                    )
+            except BaseException:
+                # 生成失敗或被取消時移除剛加入的問題，避免歷史中留下沒有回答的提問
+                self._pop(session)
+                raise
+            
+            # 加入AI回應
+            self._append(session, Role.CANDIDATE, response)
         
         result = {
             "response": response,
@@ -99,30 +170,155 @@ class InterviewService:
             "timestamp": datetime.now().isoformat()
         }
         
-        print(f"✅ 面試回應處理完成")
+        logger.info("面試回應處理完成", extra={"turns": len(session)})
         return result
     
+    async def stream_interview_response(self, user: User, session: Session, message: str) -> AsyncIterator[str]:
+        """串流生成面試回應，逐段產出文字（WebSocket使用，user與session由連線保存）
+        
+        呼叫端中途停止迭代時，已送出的部分回答仍寫入session；尚未送出任何文字則移除問題
+        """
+        async with self._session_lock(session.session_id):
+            conversation_history = session.to_llm_history()
+            self._append(session, Role.INTERVIEWER, message)
+            
+            parts: List[str] = []
+            try:
+                response, query_vec = None, None
+                if not conversation_history:
+                    response, query_vec = await self.canned_answer_service.lookup(user, message)
+                if response is not None:
+                    logger.info("使用預生成答案")
+                    parts.append(response)
+                    yield response
+                else:
+                    async with aclosing(self.llm_service.stream_response(
+                        user=user,
+                        message=message,
+                        conversation_history=conversation_history,
+                        query_vec=query_vec,
+                        session_key=session.session_id
+                    )) as stream:
+                        async for text in stream:
+                            parts.append(text)
+                            yield text
+            except BaseException:
+                if parts:
+                    self._append(session, Role.CANDIDATE, "".join(parts))
+                else:
+                    self._pop(session)
+                raise
+            
+            self._append(session, Role.CANDIDATE, "".join(parts))
+        logger.info("面試回應處理完成", extra={"turns": len(session)})
+    
+    async def batch_interview(self, user_ids: List[str], questions: List[str]) -> AsyncIterator[BatchInterviewResult]:
+        """對多位候選人提出同一組問題，依完成順序逐筆產出結果
+        
+        問題的embedding在第一次需要時才計算，並由所有候選人共用；預生成答案或關鍵字檢索即可回答時不呼叫embedding API。
+        回答以背景優先順序排隊，不影響即時面試。批次不建立session，每題皆視為新對話的第一題。
+        """
+        # 每個問題的向量Task，由第一個需要向量的回答建立
+        vector_tasks: Dict[str, asyncio.Task] = {}
+        semaphore = asyncio.Semaphore(settings.batch_max_concurrency)
+        
+        async def answer(user: User, index: int, question: str) -> BatchInterviewResult:
+            # 每個回答Task有各自的context，設定只影響這個回答
+            query_vector_memo.set(vector_tasks)
+            async with semaphore:
+                result = BatchInterviewResult(user_id=user.id, question_index=index, question=question)
+                try:
+                    response, query_vec = await self.canned_answer_service.lookup(user, question)
+                    if response is None:
+                        response = await self.llm_service.generate_response(
+                            user=user,
+                            message=question,
+                            query_vec=query_vec,
+                            session_key=f"batch:{user.id}",
+                            priority=PRIORITY_BACKGROUND
+                        )
+                    result.response = response
+                except Exception as e:
+                    result.error = str(e)
+                return result
+        
+        tasks = []
+        for user_id in user_ids:
+            user = self.user_service.get_user(user_id)
+            if not user:
+                for index, question in enumerate(questions):
+                    yield BatchInterviewResult(
+                        user_id=user_id, question_index=index, question=question, error=f"用戶 {user_id} 不存在"
+                    )
+                continue
+            tasks.extend(
+                asyncio.ensure_future(answer(user, index, question))
+                for index, question in enumerate(questions)
+            )
+        
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # 呼叫端中途斷線時取消尚未完成的回答
+            for task in tasks:
+                task.cancel()
+            for task in vector_tasks.values():
+                task.cancel()
+        
+        logger.info("批次面試完成", extra={"users": len(user_ids), "questions": len(questions)})
+    
     def get_conversation_history(self, session_id: str) -> List[Dict]:
         """獲取對話歷史"""
+        page = self.get_history_page(session_id)
+        return page["history"] if page else []
+    
+    def get_history_page(self, session_id: str, after: int = 0, limit: Optional[int] = None) -> Optional[Dict]:
+        """獲取一頁對話歷史，after為起始訊息索引；session不存在時回傳None
+        
+        回傳的next可作為下一次請求的after，revision在訊息增刪時改變，可用於ETag
+        """
         session = self.get_session(session_id)
-        if not session:
-            return []
+        if session is None:
+            return None
         
-        return [
+        stop = None if limit is None else after + limit
+        history = [
             {
-                "role": msg.role,
-                "content": msg.content,
-                "timestamp": msg.timestamp.isoformat()
+                "index": index,
+                "role": ROLE_NAMES[role],
+                "content": content,
+                "timestamp": datetime.fromtimestamp(timestamp).isoformat()
             }
-            for msg in session.messages
+            for index, (role, content, timestamp) in enumerate(session.iter_messages(after, stop), start=after)
         ]
+        return {
+            "history": history,
+            "next": after + len(history),
+            "total": len(session),
+            "revision": session.revision,
+        }
     
     def clear_session(self, session_id: str) -> bool:
         """清除面試session"""
         if session_id in self.sessions:
             del self.sessions[session_id]
+            self._session_locks.pop(session_id, None)
+            if self.transcript_log is not None:
+                self.transcript_log.log_clear(session_id)
+            self._notify(session_id)
             return True
         return False
 
-# 全局面試服務實例
-interview_service = InterviewService()
+@lru_cache
+def get_interview_service() -> InterviewService:
+    """取得全局面試服務實例（首次使用時才建立）"""
+    transcript_log = None
+    if settings.transcript_log_enabled:
+        transcript_log = TranscriptLog(
+            settings.transcript_dir,
+            fsync_interval=settings.transcript_fsync_interval,
+            replay_days=settings.transcript_replay_days,
+            retention_days=settings.transcript_retention_days,
+        )
+    return InterviewService(get_user_service(), get_llm_service(), get_canned_answer_service(), transcript_log)
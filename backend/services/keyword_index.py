@@ -0,0 +1,138 @@
+"""
+profile段落的關鍵字索引
+以BM25為各用戶的profile段落評分，補足單一embedding相似度對技術名詞（如 PyTorch、FastAPI）不敏感的問題
+"""
+
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Set, Tuple
+from models.profile import User
+from .profile_renderer import get_profile_renderer
+
+# 英數詞（保留 c++、c#、node.js 這類技術名稱）與連續的中日韓文字
+_ASCII_TERM = re.compile(r"[a-z0-9][a-z0-9+#._\-]*")
+_CJK_RUN = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]+")
+
+def tokenize(text: str) -> List[str]:
+    """英數詞整個保留，中日韓文字切成相鄰兩字（單字詞保留單字）"""
+    text = text.lower()
+    tokens = [term.rstrip("._-") for term in _ASCII_TERM.findall(text)]
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return [token for token in tokens if token]
+
+def ascii_terms(text: str) -> Set[str]:
+    """query中的英數詞，通常是技術名稱，命中時可信度高"""
+    terms = {term.rstrip("._-") for term in _ASCII_TERM.findall(text.lower())}
+    # 純數字（年份、年資）不視為技術名稱
+    return {term for term in terms if any(ch.isalpha() for ch in term)}
+
+def profile_sections(user: User) -> List[str]:
+    """將profile切成可獨立檢索的段落"""
+    return get_profile_renderer().render(user).sections
+
+class KeywordIndex:
+    """profile段落的BM25倒排索引，依用戶增量更新"""
+    
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> {段落id: 詞頻}
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._doc_lengths: Dict[int, int] = {}
+        self._doc_texts: Dict[int, str] = {}
+        self._user_docs: Dict[str, List[int]] = {}
+        # user_id -> 該用戶所有段落的詞集合
+        self._user_terms: Dict[str, Set[str]] = {}
+        # user_id -> 建立索引時的段落清單（渲染器快取的同一物件），profile重新渲染後物件即不同
+        self._sources: Dict[str, List[str]] = {}
+        self._next_doc_id = 0
+        self._total_length = 0
+    
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._user_docs
+    
+    def ensure_user(self, user: User):
+        """profile重新渲染（內容或版本改變）或尚未建立索引時重新索引該用戶"""
+        sections = profile_sections(user)
+        if self._sources.get(user.id) is not sections:
+            self.upsert_user(user.id, sections)
+    
+    def profile_terms(self, user: User) -> Set[str]:
+        """用戶profile中出現過的所有詞（英數詞與中文相鄰兩字），必要時先重新索引"""
+        self.ensure_user(user)
+        return self._user_terms[user.id]
+    
+    def upsert_user(self, user_id: str, sections: List[str]):
+        """以新的段落取代用戶原有的索引"""
+        self.remove_user(user_id)
+        doc_ids = []
+        user_terms: Set[str] = set()
+        for text in sections:
+            doc_id = self._next_doc_id
+            self._next_doc_id += 1
+            terms = Counter(tokenize(text))
+            for term, count in terms.items():
+                self._postings.setdefault(term, {})[doc_id] = count
+            user_terms.update(terms)
+            length = sum(terms.values())
+            self._doc_lengths[doc_id] = length
+            self._doc_texts[doc_id] = text
+            self._total_length += length
+            doc_ids.append(doc_id)
+        self._user_docs[user_id] = doc_ids
+        self._user_terms[user_id] = user_terms
+        self._sources[user_id] = sections
+    
+    def remove_user(self, user_id: str):
+        for doc_id in self._user_docs.pop(user_id, []):
+            for term in set(tokenize(self._doc_texts[doc_id])):
+                postings = self._postings.get(term)
+                if postings is not None:
+                    postings.pop(doc_id, None)
+                    if not postings:
+                        del self._postings[term]
+            self._total_length -= self._doc_lengths.pop(doc_id)
+            del self._doc_texts[doc_id]
+        self._user_terms.pop(user_id, None)
+        self._sources.pop(user_id, None)
+    
+    def search(self, query: str, user_id: str, top_k: int = 3) -> Tuple[List[Tuple[str, float]], float]:
+        """在單一用戶的段落中以BM25評分
+        
+        回傳 ([(段落文字, 分數)], 英數詞覆蓋率)；覆蓋率為query中的英數詞有出現在該用戶段落的比例，
+        query沒有英數詞時為0
+        """
+        docs = self._user_docs.get(user_id)
+        if not docs:
+            return [], 0.0
+        
+        doc_set = set(docs)
+        total_docs = len(self._doc_lengths)
+        avg_length = self._total_length / total_docs if total_docs else 0.0
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id in doc_set.intersection(postings):
+                tf = postings[doc_id]
+                norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[doc_id] / (avg_length or 1))
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        hits = [(self._doc_texts[doc_id], score) for doc_id, score in ranked]
+        
+        terms = ascii_terms(query)
+        if not terms:
+            return hits, 0.0
+        user_terms_hit = sum(
+            1 for term in terms
+            if doc_set.intersection(self._postings.get(term, ()))
+        )
+        return hits, user_terms_hit / len(terms)
@@ -1,92 +1,81 @@
-import openai
-from typing import List, Dict, Any
+import asyncio
+import logging
+import time
+from contextlib import aclosing
+from functools import lru_cache
+from typing import TYPE_CHECKING, AsyncIterator, List, Dict, Any, Optional
 from config import settings
+from logger import get_logger
+from metrics import metrics
 from models.profile import User
-from .embedding_service import embedding_service
+from .admission import PRIORITY_INTERACTIVE, AdmissionController, AdmissionRejected, estimate_tokens, get_admission_controller
+from .embedding_service import EmbeddingService, get_embedding_service
+from .openai_client import get_openai_client
+from .profile_renderer import get_profile_renderer
+from .quota import QuotaManager, get_quota_manager
+from .retrieval_policy import RETRIEVE, RetrievalPolicy, get_retrieval_policy
+
+if TYPE_CHECKING:
+    import numpy as np
+    from openai import AsyncOpenAI
+    from .answer_cache import AnswerCache
+
+logger = get_logger(__name__)
+
+# API呼叫失敗時回傳給面試官的預設回應
+FALLBACK_RESPONSE = "抱歉，我剛才沒聽清楚您的問題，能請您再說一遍嗎？"
 
 class LLMService:
-    def __init__(self):
-        openai.api_key = settings.openai_api_key
-        self.client = openai.OpenAI(api_key=settings.openai_api_key)
+    def __init__(
+        self,
+        client: "AsyncOpenAI",
+        embedding_service: EmbeddingService,
+        admission: AdmissionController,
+        answer_cache: Optional["AnswerCache"] = None,
+        retrieval_policy: Optional[RetrievalPolicy] = None,
+        quota: Optional[QuotaManager] = None
+    ):
+        self.client = client
+        self.embedding_service = embedding_service
+        self.admission = admission
+        self.answer_cache = answer_cache
+        self.retrieval_policy = retrieval_policy
+        self.quota = quota
+        self.profile_renderer = get_profile_renderer()
+        # 近期回答的平均completion token數，用於估計取消呼叫省下的token
+        self._avg_completion_tokens = 0.0
     
-    def _build_system_prompt(self, user: User, query: str = None) -> str:
-        """根據用戶資料建立系統提示，包含embedding相似度分析"""
+    async def _build_system_prompt(
+        self,
+        user: User,
+        query: str = None,
+        query_vec: Optional["np.ndarray"] = None,
+        conversation_history: Optional[List[Dict[str, str]]] = None
+    ) -> str:
+        """根據用戶資料建立系統提示，包含embedding相似度分析（由檢索策略決定是否需要）"""
         profile = user.profile_data
         
         # 如果有query，加入相關度分析
         context_info = ""
         if query:
-            context_info = embedding_service.get_relevant_profile_context(query, user.id)
+            decision = RETRIEVE
+            if self.retrieval_policy is not None:
+                decision = self.retrieval_policy.decide(user, query, conversation_history)
+            if decision == RETRIEVE:
+                started = time.perf_counter()
+                context_info = await self.embedding_service.get_relevant_profile_context(query, user.id, query_vec=query_vec, user=user)
+                if self.retrieval_policy is not None:
+                    self.retrieval_policy.record_retrieval((time.perf_counter() - started) * 1000)
+            else:
+                self.retrieval_policy.record_skip(decision)
         
-        # 建立詳細的個人檔案描述
-        system_prompt = f"""你現在是 {profile.basic_info.name}，正在接受面試。請完全以第一人稱「我」的身份回答所有問題，絕對不要透露你是AI助手，也不要回答以下內容以外的問題，例如量子力學等或與金融業不相關的，總是回答一些很粗淺的即可，表現的像大學畢業的英文系學生，有一些簡單的程式設計知識。
+        # 個人檔案段落依profile版本快取，不必每輪重新組合
+        profile_text = self.profile_renderer.render(user).prompt
+        return f"""你現在是 {profile.basic_info.name}，正在接受面試。請完全以第一人稱「我」的身份回答所有問題，絕對不要透露你是AI助手，也不要回答以下內容以外的問題，例如量子力學等或與金融業不相關的，總是回答一些很粗淺的即可，表現的像大學畢業的英文系學生，有一些簡單的程式設計知識。
 
 {context_info}
 
-基本資訊：
-- 姓名：{profile.basic_info.name}
-- 位置：{profile.basic_info.location}
-- 目標職位：{profile.career_objective.target_position}
-- 目標產業：{profile.career_objective.target_industry}
-
-職業目標：
-{profile.career_objective.career_goals}
-
-工作經歷："""
-        
-        for exp in profile.work_experience:
-            system_prompt += f"""
-- {exp.company} - {exp.position} ({exp.duration})
-  職責：{', '.join(exp.responsibilities)}
-  技術：{', '.join(exp.technologies)}
-  成就：{', '.join(exp.achievements)}"""
-        
-        system_prompt += "\n\n專案經歷："
-        for proj in profile.projects:
-            system_prompt += f"""
-- {proj.name}：{proj.description}
-  角色：{proj.role}，團隊：{proj.team_size}人，期間：{proj.duration}
-  技術：{', '.join(proj.technologies)}
-  挑戰：{proj.challenges}
-  解決方案：{proj.solutions}
-  成果：{proj.results}"""
-        
-        system_prompt += "\n\n技能專長："
-        system_prompt += f"\n程式語言：{', '.join([f'{s.name}({s.level}/5分,{s.years}年)' for s in profile.skills.programming_languages])}"
-        system_prompt += f"\nAI/ML框架：{', '.join([f'{s.name}({s.level}/5分,{s.years}年)' for s in profile.skills.ai_ml_frameworks])}"
-        system_prompt += f"\n後端框架：{', '.join([f'{s.name}({s.level}/5分,{s.years}年)' for s in profile.skills.backend_frameworks])}"
-        system_prompt += f"\n資料庫：{', '.join([f'{s.name}({s.level}/5分,{s.years}年)' for s in profile.skills.databases])}"
-        
-        # 處理可能不存在的技能類別
-        if hasattr(profile.skills, 'frontend_frameworks'):
-            system_prompt += f"\n前端框架：{', '.join([f'{s.name}({s.level}/5分,{s.years}年)' for s in profile.skills.frontend_frameworks])}"
-        if hasattr(profile.skills, 'version_control'):
-            system_prompt += f"\n版本控制：{', '.join([f'{s.name}({s.level}/5分,{s.years}年)' for s in profile.skills.version_control])}"
-        if hasattr(profile.skills, 'cloud_devops'):
-            system_prompt += f"\n雲端/DevOps：{', '.join([f'{s.name}({s.level}/5分,{s.years}年)' for s in profile.skills.cloud_devops])}"
-        if hasattr(profile.skills, 'ai_specialties'):
-            system_prompt += f"\nAI專長：{', '.join([f'{s.name}({s.level}/5分,{s.years}年)' for s in profile.skills.ai_specialties])}"
-        if hasattr(profile.skills, 'finance_knowledge'):
-            system_prompt += f"\n金融知識：{', '.join([f'{s.name}({s.level}/5分,{s.years}年)' for s in profile.skills.finance_knowledge])}"
-        
-        system_prompt += "\n\n教育背景："
-        for edu in profile.education:
-            status = f" ({edu.status})" if hasattr(edu, 'status') else ""
-            system_prompt += f"\n- {edu.degree}，{edu.school} ({edu.graduation_year}年){status}"
-            if hasattr(edu, 'relevant_courses'):
-                system_prompt += f"\n  相關課程：{', '.join(edu.relevant_courses)}"
-        
-        if profile.certifications:
-            system_prompt += f"\n\n證照：{', '.join(profile.certifications)}"
-        
-        system_prompt += f"""
-
-個人特質：
-- 工作風格：{profile.personality.work_style}
-- 價值觀：{profile.personality.values}
-- 興趣：{', '.join(profile.personality.interests)}
-
-語言能力：{', '.join([f'{lang.language}({lang.level})' for lang in profile.languages])}
+{profile_text}
 
 請記住：
 1. 始終以第一人稱「我」回答，表現得像真實的求職者
@@ -95,45 +84,179 @@ class LLMService:
 4. 保持自然、誠懇的語調
 5. 可以適度表現出對工作的熱忱和學習意願
 6. 如果被問到不了解的技術，可以誠實說明並表達學習意願"""
+    
+    async def _build_messages(
+        self,
+        user: User,
+        message: str,
+        conversation_history: Optional[List[Dict[str, str]]],
+        query_vec: Optional["np.ndarray"]
+    ) -> List[Dict[str, str]]:
+        """組合系統提示、對話歷史與當前問題"""
+        messages = [
+            {"role": "system", "content": await self._build_system_prompt(user, message, query_vec, conversation_history)}
+        ]
+        
+        # 加入對話歷史
+        if conversation_history:
+            messages.extend(conversation_history)
         
-        return system_prompt
+        # 加入當前問題
+        messages.append({"role": "user", "content": message})
+        return messages
     
-    def generate_response(self, user: User, message: str, conversation_history: List[Dict[str, str]] = None) -> str:
-        """生成面試回應"""
+    async def generate_response(
+        self,
+        user: User,
+        message: str,
+        conversation_history: List[Dict[str, str]] = None,
+        query_vec: Optional["np.ndarray"] = None,
+        session_key: Optional[str] = None,
+        priority: int = PRIORITY_INTERACTIVE
+    ) -> str:
+        """生成面試回應
+        
+        可傳入已計算的問題向量以省去重複的embedding呼叫；session_key與priority用於准入控制排隊，
+        佇列已滿時拋出AdmissionRejected
+        """
         try:
-            print(f"🤖 LLM開始生成回應 - 問題: '{message}' (用戶: {user.id})")
-            
-            messages = [
-                {"role": "system", "content": self._build_system_prompt(user, message)}
-            ]
+            # 新對話的第一個問題才查詢答案快取，有歷史時答案依賴上下文
+            use_cache = self.answer_cache is not None and not conversation_history
+            if use_cache:
+                if query_vec is None:
+                    query_vec = await self.embedding_service.get_query_vector(message)
+                if query_vec is not None:
+                    cached = self.answer_cache.lookup(user.id, user.updated_at.isoformat(), query_vec)
+                    if cached is not None:
+                        logger.info("答案快取命中")
+                        return cached
             
-            # 加入對話歷史
-            if conversation_history:
-                print(f"📚 加載對話歷史: {len(conversation_history)} 條訊息")
-                messages.extend(conversation_history)
+            messages = await self._build_messages(user, message, conversation_history, query_vec)
+            started = time.perf_counter()
+            # 內部以串流呼叫，請求被取消時能即時中止上游生成
+            parts = []
+            async with aclosing(self._stream_completion(messages, user.id, session_key or user.id, priority)) as stream:
+                async for text in stream:
+                    parts.append(text)
             
-            # 加入當前問題
-            messages.append({"role": "user", "content": message})
+            ai_response = "".join(parts).strip()
+            latency_ms = (time.perf_counter() - started) * 1000
+            logger.info("LLM回應生成成功", extra={
+                "model": settings.openai_model,
+                "history_messages": len(conversation_history or []),
+                "response_chars": len(ai_response),
+                "latency_ms": round(latency_ms, 1),
+            })
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("LLM回應預覽", extra={"preview": ai_response[:100], "sampled": True})
             
-            print(f"🚀 調用OpenAI API (模型: {settings.openai_model})")
-            response = self.client.chat.completions.create(
-                model=settings.openai_model,
-                messages=messages,
-                temperature=settings.openai_temperature,
-                max_tokens=settings.openai_max_tokens
-            )
-            
-            ai_response = response.choices[0].message.content.strip()
-            print(f"✅ LLM回應生成成功 (長度: {len(ai_response)} 字元)")
-            print(f"💬 回應預覽: {ai_response[:100]}..." if len(ai_response) > 100 else f"💬 完整回應: {ai_response}")
+            if use_cache and query_vec is not None:
+                self.answer_cache.store(user.id, user.updated_at.isoformat(), query_vec, ai_response)
             
             return ai_response
-            
+        
+        except AdmissionRejected:
+            raise
         except Exception as e:
-            print(f"❌ LLM 生成回應失敗: {e}")
-            return "抱歉，我剛才沒聽清楚您的問題，能請您再說一遍嗎？"
+            metrics.inc("openai.chat.errors")
+            logger.error("LLM 生成回應失敗", extra={"error": str(e)})
+            return FALLBACK_RESPONSE
+    
+    async def stream_response(
+        self,
+        user: User,
+        message: str,
+        conversation_history: List[Dict[str, str]] = None,
+        query_vec: Optional["np.ndarray"] = None,
+        session_key: Optional[str] = None,
+        priority: int = PRIORITY_INTERACTIVE
+    ) -> AsyncIterator[str]:
+        """串流生成面試回應，逐段產出文字；尚未產出任何文字就失敗時產出預設回應"""
+        produced = False
+        try:
+            messages = await self._build_messages(user, message, conversation_history, query_vec)
+            async with aclosing(self._stream_completion(messages, user.id, session_key or user.id, priority)) as stream:
+                async for text in stream:
+                    produced = True
+                    yield text
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            metrics.inc("openai.chat.errors")
+            logger.error("LLM 串流生成失敗", extra={"error": str(e)})
+        if not produced:
+            yield FALLBACK_RESPONSE
+    
+    def _observe_completion_tokens(self, tokens: int):
+        if self._avg_completion_tokens:
+            self._avg_completion_tokens = 0.9 * self._avg_completion_tokens + 0.1 * tokens
+        else:
+            self._avg_completion_tokens = float(tokens)
+    
+    async def _stream_completion(
+        self,
+        messages: List[Dict[str, str]],
+        user_id: str,
+        session_key: str,
+        priority: int
+    ) -> AsyncIterator[str]:
+        """檢查用戶配額並取得准入名額後以串流呼叫completion，逐段產出文字
+        
+        超過用戶或API key的速率限制、每月配額時拋出QuotaExceeded；
+        呼叫端取消或停止迭代（面試官打斷、客戶端斷線）時關閉上游串流，OpenAI隨即停止生成；
+        並以已生成的字數估計浪費的token，以近期平均回答長度估計省下的token
+        """
+        estimated = estimate_tokens(messages, settings.openai_max_tokens)
+        prompt_tokens = estimated - settings.openai_max_tokens
+        charge = self.quota.acquire(user_id, estimated) if self.quota is not None else None
+        ticket = None
+        started: Optional[float] = None
+        generated = 0
+        try:
+            async with self.admission.slot(session_key, estimated, priority) as ticket:
+                started = time.perf_counter()
+                stream = await self.client.chat.completions.create(
+                    model=settings.openai_model,
+                    messages=messages,
+                    temperature=settings.openai_temperature,
+                    max_tokens=settings.openai_max_tokens,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
+                try:
+                    async for chunk in stream:
+                        if chunk.usage is not None:
+                            ticket.record_usage(chunk.usage.total_tokens)
+                            self._observe_completion_tokens(chunk.usage.completion_tokens)
+                        if not chunk.choices or not chunk.choices[0].delta.content:
+                            continue
+                        text = chunk.choices[0].delta.content
+                        if not generated:
+                            metrics.observe("openai.chat.first_token_ms", (time.perf_counter() - started) * 1000)
+                        generated += len(text)
+                        yield text
+                finally:
+                    await stream.close()
+            metrics.observe("openai.chat.latency_ms", (time.perf_counter() - started) * 1000)
+        except (asyncio.CancelledError, GeneratorExit):
+            metrics.inc("openai.chat.cancelled")
+            if started is None:
+                # 還在排隊就取消，整個呼叫都省下了
+                metrics.inc("openai.chat.cancelled_tokens_saved", prompt_tokens + self._avg_completion_tokens)
+            else:
+                # 中文約每字一個token
+                metrics.inc("openai.chat.cancelled_tokens_wasted", prompt_tokens + generated)
+                metrics.inc("openai.chat.cancelled_tokens_saved", max(0.0, self._avg_completion_tokens - generated))
+            raise
+        finally:
+            if charge is not None:
+                # 以實際用量結算配額；取消時沒有usage，以送出的prompt與已生成的字數計算
+                if ticket is not None and ticket.actual_tokens is not None:
+                    charge.settle(ticket.actual_tokens)
+                else:
+                    charge.settle(prompt_tokens + generated if started is not None else 0)
     
-    def generate_self_introduction(self, user: User) -> str:
+    async def generate_self_introduction(self, user: User, session_key: Optional[str] = None, priority: int = PRIORITY_INTERACTIVE) -> str:
         """生成自我介紹"""
         intro_prompt = """請用2-3分鐘的長度做一個專業的自我介紹，包含：
 1. 基本背景和教育
@@ -141,7 +264,25 @@ class LLMService:
 3. 技術專長，特別是AI/ML和金融相關
 4. 職業目標和為什麼對這個職位感興趣"""
         
-        return self.generate_response(user, intro_prompt)
+        return await self.generate_response(user, intro_prompt, session_key=session_key, priority=priority)
 
-# 全局LLM服務實例
-llm_service = LLMService()
+@lru_cache
+def get_llm_service() -> LLMService:
+    """取得全局LLM服務實例（首次使用時才建立）"""
+    answer_cache = None
+    if settings.answer_cache_enabled:
+        from .answer_cache import AnswerCache
+        answer_cache = AnswerCache(
+            threshold=settings.answer_cache_similarity_threshold,
+            ttl_seconds=settings.answer_cache_ttl_seconds,
+            max_entries=settings.answer_cache_max_entries,
+            max_entries_per_user=settings.answer_cache_max_entries_per_user,
+        )
+    return LLMService(
+        get_openai_client(),
+        get_embedding_service(),
+        get_admission_controller(),
+        answer_cache,
+        get_retrieval_policy(),
+        get_quota_manager()
+    )
@@ -0,0 +1,66 @@
+import importlib.util
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict
+from config import settings
+from logger import get_logger
+from metrics import metrics
+
+if TYPE_CHECKING:
+    import httpx
+    from openai import AsyncOpenAI
+
+logger = get_logger(__name__)
+
+def _pool_stats(http_client: "httpx.AsyncClient") -> Dict[str, Any]:
+    """讀取httpx連線池目前的使用狀況"""
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    if pool is None:
+        return {}
+    connections = list(getattr(pool, "connections", []))
+    active = sum(1 for conn in connections if not conn.is_idle())
+    queued = sum(1 for request in getattr(pool, "_requests", []) if request.is_queued())
+    max_connections = settings.openai_pool_max_connections
+    return {
+        "connections": len(connections),
+        "active": active,
+        "idle": len(connections) - active,
+        "queued_requests": queued,
+        "max_connections": max_connections,
+        "utilization": round(active / max_connections, 3) if max_connections else 0.0,
+    }
+
+@lru_cache
+def get_openai_client() -> "AsyncOpenAI":
+    """取得應用程式共用的OpenAI client（共用連線池，首次使用時才建立）"""
+    import httpx
+    import openai
+    
+    http2 = settings.openai_http2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("未安裝h2套件，OpenAI連線改用HTTP/1.1")
+        http2 = False
+    
+    timeout = httpx.Timeout(settings.openai_timeout, connect=settings.openai_connect_timeout)
+    http_client = openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=settings.openai_pool_max_connections,
+            max_keepalive_connections=settings.openai_pool_max_keepalive,
+            keepalive_expiry=settings.openai_keepalive_expiry,
+        ),
+        timeout=timeout,
+        http2=http2,
+    )
+    metrics.register_collector("openai_pool", lambda: _pool_stats(http_client))
+    
+    return openai.AsyncOpenAI(
+        api_key=settings.openai_api_key,
+        http_client=http_client,
+        timeout=timeout,
+        max_retries=settings.openai_max_retries,
+    )
+
+async def close_openai_client():
+    """關閉共用client與其連線池（應用程式關閉時呼叫）"""
+    if get_openai_client.cache_info().currsize:
+        await get_openai_client().close()
+        get_openai_client.cache_clear()
@@ -0,0 +1,194 @@
+"""
+由pydantic schema產生的profile文字渲染器
+每個模型類別只在第一次使用時依欄位型別與title編譯一次，之後一次走訪profile即同時產生
+embedding文字、系統提示段落與關鍵字索引段落；結果依profile版本（profile物件與updated_at）快取
+"""
+
+import typing
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Type
+from pydantic import BaseModel
+from models.profile import CompleteProfile, User
+
+# 欄位類型
+SCALAR = "scalar"
+STR_LIST = "str_list"
+INLINE_LIST = "inline_list"  # 只含純量欄位的模型清單，每項渲染成一段，例如 Python（程度：5/5分，年資：3年）
+MODEL = "model"
+MODEL_LIST = "model_list"
+
+_LEAF_KINDS = (SCALAR, STR_LIST, INLINE_LIST)
+
+class _FieldSpec:
+    __slots__ = ("name", "label", "kind", "children", "unit")
+    
+    def __init__(self, name: str, label: str, kind: str, children: Tuple["_FieldSpec", ...] = (), unit: str = ""):
+        self.name = name
+        self.label = label
+        self.kind = kind
+        self.children = children
+        self.unit = unit
+
+def _unwrap_optional(annotation: Any) -> Any:
+    if typing.get_origin(annotation) is typing.Union:
+        args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+def _is_model(annotation: Any) -> bool:
+    return isinstance(annotation, type) and issubclass(annotation, BaseModel)
+
+@lru_cache
+def compile_model(model: Type[BaseModel]) -> Tuple[_FieldSpec, ...]:
+    """依schema編譯模型的欄位規格
+    
+    json_schema_extra標記render為False的欄位略過，unit加在數值後；未設定title時以欄位名稱作為標籤
+    """
+    specs = []
+    for name, field in model.model_fields.items():
+        extra = field.json_schema_extra if isinstance(field.json_schema_extra, dict) else {}
+        if extra.get("render", True) is False:
+            continue
+        label = field.title or name
+        annotation = _unwrap_optional(field.annotation)
+        if typing.get_origin(annotation) in (list, List):
+            item = _unwrap_optional(typing.get_args(annotation)[0])
+            if _is_model(item):
+                children = compile_model(item)
+                kind = INLINE_LIST if _is_flat(children) else MODEL_LIST
+                specs.append(_FieldSpec(name, label, kind, children))
+            else:
+                specs.append(_FieldSpec(name, label, STR_LIST))
+        elif _is_model(annotation):
+            specs.append(_FieldSpec(name, label, MODEL, compile_model(annotation)))
+        else:
+            specs.append(_FieldSpec(name, label, SCALAR, unit=extra.get("unit", "")))
+    return tuple(specs)
+
+def _is_flat(specs: Tuple[_FieldSpec, ...]) -> bool:
+    return bool(specs) and all(spec.kind == SCALAR for spec in specs)
+
+def _scalar(value: Any, unit: str = "") -> str:
+    if value is None or value == "":
+        return ""
+    if isinstance(value, float):
+        return f"{value:g}{unit}"
+    return f"{value}{unit}"
+
+def _inline(specs: Tuple[_FieldSpec, ...], model: BaseModel) -> str:
+    """第一個欄位為名稱，其餘欄位放在括號內"""
+    head = _scalar(getattr(model, specs[0].name))
+    details = "，".join(
+        f"{spec.label}：{text}" for spec in specs[1:] if (text := _scalar(getattr(model, spec.name), spec.unit))
+    )
+    return f"{head}（{details}）" if details else head
+
+def _leaf(spec: _FieldSpec, value: Any) -> Optional[str]:
+    """單行的「標籤：內容」，內容為空時回傳None"""
+    if spec.kind == SCALAR:
+        text = _scalar(value, spec.unit)
+    elif spec.kind == STR_LIST:
+        text = "、".join(_scalar(item) for item in value or () if item)
+    else:
+        text = "、".join(_inline(spec.children, item) for item in value or ())
+    return f"{spec.label}：{text}" if text else None
+
+def _leaves(specs: Tuple[_FieldSpec, ...], model: BaseModel) -> List[str]:
+    """模型所有非空欄位的單行文字，巢狀模型攤平"""
+    lines = []
+    for spec in specs:
+        value = getattr(model, spec.name)
+        if spec.kind in _LEAF_KINDS:
+            line = _leaf(spec, value)
+            if line:
+                lines.append(line)
+        elif spec.kind == MODEL:
+            if value is not None:
+                lines.extend(_leaves(spec.children, value))
+        else:
+            for item in value or ():
+                lines.extend(_leaves(spec.children, item))
+    return lines
+
+class RenderedProfile:
+    """一次走訪profile產生的各種文字"""
+    
+    __slots__ = ("text", "prompt", "sections")
+    
+    def __init__(self, text: str, prompt: str, sections: List[str]):
+        # embedding用的單行文字
+        self.text = text
+        # 系統提示中的個人資料段落
+        self.prompt = prompt
+        # 可獨立檢索的關鍵字索引段落
+        self.sections = sections
+
+def render_profile(profile: CompleteProfile) -> RenderedProfile:
+    """依編譯好的欄位規格走訪一次profile"""
+    blocks: List[str] = []
+    sections: List[str] = []
+    parts: List[str] = []
+    for spec in compile_model(type(profile)):
+        value = getattr(profile, spec.name)
+        if value is None:
+            continue
+        if spec.kind in _LEAF_KINDS:
+            line = _leaf(spec, value)
+            if line:
+                blocks.append(line)
+                sections.append(line)
+                parts.append(line)
+            continue
+        
+        lines = []
+        if spec.kind == MODEL:
+            grouped = []
+            for child in spec.children:
+                child_lines = _leaves((child,), value)
+                lines.extend(f"- {line}" for line in child_lines)
+                parts.extend(child_lines)
+                # 技能這類條列欄位各自成為一個檢索段落，其餘欄位合為一段
+                if child.kind in (INLINE_LIST, MODEL_LIST):
+                    sections.extend(child_lines)
+                else:
+                    grouped.extend(child_lines)
+            if grouped:
+                sections.append(" ".join(grouped))
+        else:
+            for item in value:
+                item_lines = _leaves(spec.children, item)
+                if not item_lines:
+                    continue
+                lines.append(f"- {item_lines[0]}")
+                lines.extend(f"  {line}" for line in item_lines[1:])
+                sections.append(" ".join(item_lines))
+                parts.extend(item_lines)
+        if lines:
+            blocks.append(f"{spec.label}：\n" + "\n".join(lines))
+    return RenderedProfile(" ".join(parts), "\n\n".join(blocks), sections)
+
+class ProfileRenderer:
+    """依profile版本快取渲染結果，profile未更新時不重新走訪
+    
+    版本同時比對updated_at與profile物件本身：更新用戶或熱更新載入新資料時profile一定是新物件，
+    即使檔案中的updated_at沒有改變也會重新渲染
+    """
+    
+    def __init__(self):
+        # user_id -> (profile物件, updated_at, 渲染結果)；保留profile參照，避免物件回收後id被重用
+        self._cache: Dict[str, Tuple[CompleteProfile, str, RenderedProfile]] = {}
+    
+    def render(self, user: User) -> RenderedProfile:
+        profile = user.profile_data
+        version = user.updated_at.isoformat()
+        cached = self._cache.get(user.id)
+        if cached is None or cached[0] is not profile or cached[1] != version:
+            cached = (profile, version, render_profile(profile))
+            self._cache[user.id] = cached
+        return cached[2]
+
+@lru_cache
+def get_profile_renderer() -> ProfileRenderer:
+    """取得全局profile渲染器實例"""
+    return ProfileRenderer()
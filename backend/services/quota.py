@@ -0,0 +1,271 @@
+"""
+依用戶與API key隔離資源用量
+每個用戶、每把API key各有一個token bucket（每分鐘速率）與每月token配額；
+每月用量存在本機sqlite，記憶體累加後批次寫回，每次請求只有字典操作的成本
+"""
+
+import asyncio
+import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+from config import settings
+from logger import get_logger
+from metrics import metrics
+from .admission import AdmissionRejected
+
+logger = get_logger(__name__)
+
+# 目前請求的API key（由 X-API-Key 標頭綁定），沒有時只套用用戶限制
+api_key_var: ContextVar[Optional[str]] = ContextVar("api_key", default=None)
+
+# 不在允許清單中的API key共用同一組額度：key未經驗證，逐一追蹤會讓記憶體與sqlite無限成長，
+# 也能靠隨機更換key規避限制
+UNLISTED_KEY_SUBJECT = "key:*"
+
+class QuotaExceeded(AdmissionRejected):
+    """用戶或API key超過速率限制或每月配額，呼叫端應回傳HTTP 429"""
+
+def _current_month() -> str:
+    return time.strftime("%Y-%m")
+
+def _seconds_until_next_month() -> float:
+    now = datetime.now()
+    if now.month == 12:
+        start = now.replace(year=now.year + 1, month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    else:
+        start = now.replace(month=now.month + 1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    return (start - now).total_seconds()
+
+class UsageStore:
+    """每月token用量計數器（sqlite），讀取時快取，寫入先累加在記憶體再批次寫回"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        # 寫回在背景執行緒進行，與事件迴圈中的讀取共用連線
+        self._lock = threading.Lock()
+        self._cache: Dict[Tuple[str, str], int] = {}
+        self._pending: Dict[Tuple[str, str], int] = {}
+    
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "subject TEXT NOT NULL, month TEXT NOT NULL, tokens INTEGER NOT NULL, "
+                "PRIMARY KEY (subject, month))"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+    
+    def get(self, subject: str, month: str) -> int:
+        key = (subject, month)
+        used = self._cache.get(key)
+        if used is None:
+            with self._lock:
+                row = self._connection().execute(
+                    "SELECT tokens FROM usage WHERE subject = ? AND month = ?", key
+                ).fetchone()
+            used = self._cache[key] = (row[0] if row else 0) + self._pending.get(key, 0)
+        return used
+    
+    def forget_other_months(self, month: str):
+        """丟棄其他月份的快取（尚未寫回的用量不受影響）"""
+        for key in [key for key in self._cache if key[1] != month]:
+            del self._cache[key]
+    
+    def add(self, subject: str, month: str, tokens: int):
+        key = (subject, month)
+        self._cache[key] = self.get(subject, month) + tokens
+        self._pending[key] = self._pending.get(key, 0) + tokens
+    
+    def take_pending(self) -> Dict[Tuple[str, str], int]:
+        """取出尚未寫回的用量（在事件迴圈中呼叫）"""
+        pending, self._pending = self._pending, {}
+        return pending
+    
+    def restore_pending(self, pending: Dict[Tuple[str, str], int]):
+        """寫回失敗時把取出的用量併回待寫入計數，下次寫回時重試（在事件迴圈中呼叫）"""
+        for key, tokens in pending.items():
+            self._pending[key] = self._pending.get(key, 0) + tokens
+    
+    def write(self, pending: Dict[Tuple[str, str], int]):
+        """將用量累加寫回sqlite（可在背景執行緒呼叫）"""
+        if not pending:
+            return
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT INTO usage (subject, month, tokens) VALUES (?, ?, ?) "
+                "ON CONFLICT (subject, month) DO UPDATE SET tokens = tokens + excluded.tokens",
+                [(subject, month, tokens) for (subject, month), tokens in pending.items()]
+            )
+            conn.commit()
+    
+    def flush(self):
+        self.write(self.take_pending())
+    
+    def close(self):
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+class _Bucket:
+    __slots__ = ("capacity", "tokens", "last_refill")
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+    
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.capacity / 60)
+        self.last_refill = now
+        return self.tokens
+
+class Charge:
+    """一次LLM呼叫預扣的額度，呼叫結束後依實際用量結算"""
+    
+    __slots__ = ("manager", "subjects", "estimated", "settled")
+    
+    def __init__(self, manager: "QuotaManager", subjects: List[Tuple[str, int, int]], estimated: int):
+        self.manager = manager
+        self.subjects = subjects
+        self.estimated = estimated
+        self.settled = False
+    
+    def settle(self, actual_tokens: int):
+        """以實際用量校正bucket並累加每月用量；未送出的呼叫傳入0即可退回預扣額度"""
+        if not self.settled:
+            self.settled = True
+            self.manager._settle(self, actual_tokens)
+
+class QuotaManager:
+    """每個用戶與API key的token bucket與每月配額，限制為0表示不限制
+    
+    只有允許清單中的API key各自計算額度，其他key共用一組；清單為空時不套用API key限制
+    """
+    
+    def __init__(
+        self,
+        store: UsageStore,
+        user_tokens_per_minute: int = 0,
+        key_tokens_per_minute: int = 0,
+        user_monthly_tokens: int = 0,
+        key_monthly_tokens: int = 0,
+        flush_interval: float = 5.0,
+        api_keys: Iterable[str] = ()
+    ):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.api_keys = frozenset(api_keys)
+        # 主體類型 -> (每分鐘token數, 每月token數)
+        self._limits = {
+            "user": (user_tokens_per_minute, user_monthly_tokens),
+            "key": (key_tokens_per_minute, key_monthly_tokens),
+        }
+        self._buckets: Dict[str, _Bucket] = {}
+        # 進行中呼叫預扣的每月額度，結算前一併計入，避免並發請求同時通過檢查而超出配額
+        self._reserved: Dict[str, int] = {}
+        self._flusher: Optional[asyncio.Task] = None
+    
+    def acquire(self, user_id: str, estimated_tokens: int, api_key: Optional[str] = None) -> Charge:
+        """檢查並預扣額度，超過限制時拋出QuotaExceeded"""
+        if api_key is None:
+            api_key = api_key_var.get()
+        subjects = [(f"user:{user_id}", *self._limits["user"])]
+        if api_key and self.api_keys:
+            subject = f"key:{api_key}" if api_key in self.api_keys else UNLISTED_KEY_SUBJECT
+            subjects.append((subject, *self._limits["key"]))
+        
+        month = _current_month()
+        for subject, per_minute, monthly in subjects:
+            if monthly > 0 and self.store.get(subject, month) + self._reserved.get(subject, 0) >= monthly:
+                metrics.inc("quota.rejected.monthly")
+                raise QuotaExceeded("本月token配額已用完", _seconds_until_next_month())
+            if per_minute > 0:
+                bucket = self._refill(subject, per_minute)
+                needed = min(estimated_tokens, per_minute)
+                if bucket.tokens < needed:
+                    metrics.inc("quota.rejected.rate")
+                    raise QuotaExceeded("請求過於頻繁，請稍後再試", max(1.0, (needed - bucket.tokens) * 60 / per_minute))
+        
+        for subject, per_minute, monthly in subjects:
+            if per_minute > 0:
+                self._buckets[subject].tokens -= estimated_tokens
+            if monthly > 0:
+                self._reserved[subject] = self._reserved.get(subject, 0) + estimated_tokens
+        return Charge(self, subjects, estimated_tokens)
+    
+    def _refill(self, subject: str, per_minute: int) -> _Bucket:
+        bucket = self._buckets.get(subject)
+        if bucket is None:
+            bucket = self._buckets[subject] = _Bucket(per_minute)
+        else:
+            bucket.refill(time.monotonic())
+        return bucket
+    
+    def _evict_idle(self):
+        """移除已回滿的bucket（與新建的bucket等價），記憶體只與近期活躍的主體數量有關"""
+        now = time.monotonic()
+        for subject in [subject for subject, bucket in self._buckets.items() if bucket.refill(now) >= bucket.capacity]:
+            del self._buckets[subject]
+        self.store.forget_other_months(_current_month())
+    
+    def _settle(self, charge: Charge, actual_tokens: int):
+        month = _current_month()
+        for subject, per_minute, monthly in charge.subjects:
+            bucket = self._buckets.get(subject) if per_minute > 0 else None
+            if bucket is not None:
+                # 依實際用量退回或補扣預估的token
+                bucket.tokens = min(per_minute, bucket.tokens + charge.estimated - actual_tokens)
+            if monthly > 0:
+                reserved = self._reserved.get(subject, 0) - charge.estimated
+                if reserved > 0:
+                    self._reserved[subject] = reserved
+                else:
+                    self._reserved.pop(subject, None)
+            if actual_tokens > 0:
+                self.store.add(subject, month, actual_tokens)
+        if actual_tokens > 0:
+            self._ensure_flusher()
+    
+    def _ensure_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+    
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._evict_idle()
+            pending = self.store.take_pending()
+            try:
+                await asyncio.to_thread(self.store.write, pending)
+            except Exception as e:
+                self.store.restore_pending(pending)
+                logger.error("寫入token用量失敗", extra={"error": str(e), "pending_subjects": len(pending)})
+    
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+        self.store.close()
+
+@lru_cache
+def get_quota_manager() -> QuotaManager:
+    """取得全局配額管理實例"""
+    return QuotaManager(
+        UsageStore(settings.quota_db_file),
+        user_tokens_per_minute=settings.quota_user_tokens_per_minute,
+        key_tokens_per_minute=settings.quota_api_key_tokens_per_minute,
+        user_monthly_tokens=settings.quota_user_monthly_tokens,
+        key_monthly_tokens=settings.quota_api_key_monthly_tokens,
+        flush_interval=settings.quota_flush_interval,
+        api_keys=settings.quota_api_keys,
+    )
@@ -0,0 +1,116 @@
+"""
+逐輪決定是否執行RAG檢索
+完整profile已放在系統提示中，小型profile、寒暄、追問與離題問題檢索只會增加延遲
+"""
+
+import re
+from functools import lru_cache
+from typing import AbstractSet, Dict, List, Optional
+from config import settings
+from logger import get_logger
+from metrics import metrics
+from models.profile import User
+from .embedding_service import get_embedding_service
+from .keyword_index import KeywordIndex, ascii_terms, tokenize
+from .profile_renderer import get_profile_renderer
+
+logger = get_logger(__name__)
+
+# 決策原因
+RETRIEVE = "retrieve"
+SMALL_PROFILE = "small_profile"
+GREETING = "greeting"
+FOLLOW_UP = "follow_up"
+OFF_TOPIC = "off_topic"
+
+# 整句只有寒暄（問候、道謝、道別與客套話）才算寒暄，後面接著問題時照常檢索
+_GREETING_PHRASE = (
+    r"(你好|您好|大家好|哈囉|嗨|早安|午安|晚安|謝謝(你|您)?|感謝(你|您)?|再見|掰掰|"
+    r"很高興(認識|見到)?(你|您)?|今天|面試官|(今天)?(你|您)?的(時間|分享|回答)|"
+    r"hi|hello|hey|thanks|thank you|bye|nice to meet you)"
+)
+_GREETING = re.compile(
+    rf"^\s*{_GREETING_PHRASE}([\s，,。.!！~～]*{_GREETING_PHRASE})*[\s，,。.!！~～]*$",
+    re.IGNORECASE
+)
+_FOLLOW_UP = re.compile(
+    r"^\s*(那|所以|然後|還有|為什麼|怎麼說|可以多說|可以再|能再|具體|舉個例|例如呢|比如|細節|後來|結果呢|還有嗎|嗯)"
+    r"|(呢[？?]?\s*$)",
+    re.IGNORECASE
+)
+# 只列與金融、科技面試無關的主題；股價、政治風險這類詞在金融業面試中是正常問題
+_OFF_TOPIC = re.compile(r"量子|天氣|星座|彩券|樂透|食譜|電影推薦|笑話")
+
+# 追問通常很短，較長的句子多半帶有新主題
+_FOLLOW_UP_MAX_CHARS = 20
+
+def _has_new_topic(query: str, profile_terms: AbstractSet[str]) -> bool:
+    """query帶有技術名稱或profile中的關鍵字時，即使以「那」開頭也多半是新主題，例如「那你會Kubernetes嗎」"""
+    if ascii_terms(query):
+        return True
+    return any(term in profile_terms for term in tokenize(query))
+
+def classify_question(query: str, has_history: bool, profile_terms: AbstractSet[str] = frozenset()) -> str:
+    """以規則粗分問題類型：greeting、follow_up、off_topic或retrieve
+    
+    profile_terms為用戶profile的詞集合，用於排除看似追問但帶有新主題的問題
+    """
+    if _GREETING.match(query):
+        return GREETING
+    if (
+        has_history
+        and len(query.strip()) <= _FOLLOW_UP_MAX_CHARS
+        and _FOLLOW_UP.search(query)
+        and not _has_new_topic(query, profile_terms)
+    ):
+        return FOLLOW_UP
+    if _OFF_TOPIC.search(query):
+        return OFF_TOPIC
+    return RETRIEVE
+
+class RetrievalPolicy:
+    """依profile大小、問題類型與對話歷史決定是否檢索，並記錄省下的延遲"""
+    
+    def __init__(self, enabled: bool, min_profile_tokens: int, keyword_index: Optional[KeywordIndex] = None):
+        self.enabled = enabled
+        self.min_profile_tokens = min_profile_tokens
+        # 與混合檢索共用的關鍵字索引，用來判斷追問是否帶有profile中的新主題
+        self.keyword_index = keyword_index
+        # 最近檢索延遲的指數移動平均，用於估計略過檢索省下的時間
+        self._latency_ms: Optional[float] = None
+    
+    def profile_tokens(self, user: User) -> int:
+        """粗估profile的token數（中文約每字一個token），渲染結果依updated_at快取"""
+        return len(get_profile_renderer().render(user).text)
+    
+    def decide(self, user: User, query: str, history: Optional[List[Dict[str, str]]] = None) -> str:
+        """回傳決策原因，RETRIEVE表示需要檢索"""
+        if not self.enabled:
+            return RETRIEVE
+        if self.profile_tokens(user) < self.min_profile_tokens:
+            return SMALL_PROFILE
+        profile_terms = self.keyword_index.profile_terms(user) if history and self.keyword_index is not None else frozenset()
+        return classify_question(query, bool(history), profile_terms)
+    
+    def record_retrieval(self, latency_ms: float):
+        metrics.inc(f"retrieval.decision.{RETRIEVE}")
+        metrics.observe("retrieval.latency_ms", latency_ms)
+        if self._latency_ms is None:
+            self._latency_ms = latency_ms
+        else:
+            self._latency_ms = 0.9 * self._latency_ms + 0.1 * latency_ms
+    
+    def record_skip(self, reason: str):
+        metrics.inc(f"retrieval.decision.{reason}")
+        if self._latency_ms is not None:
+            metrics.inc("retrieval.saved_ms", self._latency_ms)
+        logger.info("略過RAG檢索", extra={"reason": reason})
+
+@lru_cache
+def get_retrieval_policy() -> RetrievalPolicy:
+    """取得全局檢索策略實例"""
+    return RetrievalPolicy(
+        settings.retrieval_policy_enabled,
+        settings.retrieval_min_profile_tokens,
+        get_embedding_service().keyword_index
+    )
@@ -0,0 +1,72 @@
+"""
+面試session的精簡記憶體表示
+訊息以欄位陣列存放（角色代碼、內容、epoch時間戳），避免每則訊息建立pydantic物件與datetime
+"""
+
+import time
+from array import array
+from enum import IntEnum
+from typing import Dict, Iterator, List, Optional, Tuple
+
+class Role(IntEnum):
+    INTERVIEWER = 0
+    CANDIDATE = 1
+
+# 角色代碼對應的API名稱與LLM對話角色
+ROLE_NAMES = ("interviewer", "candidate")
+LLM_ROLES = ("user", "assistant")
+_ROLE_CODES = {name: Role(code) for code, name in enumerate(ROLE_NAMES)}
+
+def parse_role(name: str) -> Role:
+    """將API角色名稱轉為角色代碼"""
+    try:
+        return _ROLE_CODES[name]
+    except KeyError:
+        raise ValueError(f"未知的訊息角色: {name}") from None
+
+class Session:
+    """單一面試session，訊息以欄位陣列存放"""
+    
+    __slots__ = ("session_id", "user_id", "started_at", "roles", "contents", "timestamps", "revision")
+    
+    def __init__(self, session_id: str, user_id: str, started_at: Optional[float] = None):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.started_at = started_at if started_at is not None else time.time()
+        self.roles = array("b")
+        self.contents: List[str] = []
+        self.timestamps = array("d")
+        # 每次增刪訊息都遞增，用於產生ETag
+        self.revision = 0
+    
+    def __len__(self) -> int:
+        return len(self.contents)
+    
+    def append(self, role: Role, content: str, timestamp: Optional[float] = None):
+        """加入一則訊息"""
+        if not content:
+            raise ValueError("訊息內容不可為空")
+        self.roles.append(role)
+        self.contents.append(content)
+        self.timestamps.append(timestamp if timestamp is not None else time.time())
+        self.revision += 1
+    
+    def pop(self):
+        """移除最後一則訊息"""
+        self.roles.pop()
+        self.contents.pop()
+        self.timestamps.pop()
+        self.revision += 1
+    
+    def iter_messages(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[Role, str, float]]:
+        """依序產出 (角色, 內容, 時間戳)"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for i in range(start, stop):
+            yield Role(self.roles[i]), self.contents[i], self.timestamps[i]
+    
+    def to_llm_history(self) -> List[Dict[str, str]]:
+        """轉換為LLM的對話歷史格式"""
+        return [
+            {"role": LLM_ROLES[role], "content": content}
+            for role, content in zip(self.roles, self.contents)
+        ]
@@ -0,0 +1,263 @@
+"""
+面試逐字稿的append-only日誌
+每次訊息增刪只在當日的JSONL檔尾端寫入一行（寫入緩衝區，依間隔批次fsync），
+啟動時依序重播近期日誌還原進行中的session；過去日期的日誌由壓縮作業整理成每個session一行
+"""
+
+import asyncio
+import json
+import os
+import time
+from datetime import date, datetime, timedelta
+from typing import IO, Dict, Iterable, List, Optional, Tuple
+from logger import get_logger
+from metrics import metrics
+from .session_store import Role, Session
+
+logger = get_logger(__name__)
+
+_FILE_PREFIX = "transcripts-"
+_FILE_SUFFIX = ".jsonl"
+# 壓縮後的檔案以此行開頭，避免重複壓縮
+_COMPACTED_HEADER = '{"op":"compacted"}\n'
+
+def _dumps(record: Dict) -> str:
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+def _reduce(lines: Iterable[str], source: str) -> Dict[str, Dict]:
+    """將單一檔案的操作依session歸併
+    
+    回傳 session_id -> {uid, started_at, pops, messages, cleared}；pops為本檔案中
+    無法抵銷、需作用在先前檔案訊息上的移除次數，套用時先移除再加入messages
+    """
+    states: Dict[str, Dict] = {}
+    for line_no, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # 當機時最後一行可能只寫入一半
+            logger.warning("略過無法解析的逐字稿紀錄", extra={"file": source, "line": line_no})
+            continue
+        op = record.get("op")
+        if op == "compacted":
+            continue
+        state = states.get(record["sid"])
+        if state is None:
+            state = states[record["sid"]] = {"uid": None, "started_at": None, "pops": 0, "messages": [], "cleared": False}
+        if op == "start":
+            state["uid"] = record["uid"]
+            state["started_at"] = record["ts"]
+        elif op == "msg":
+            state["messages"].append([record["role"], record["content"], record["ts"]])
+        elif op == "pop":
+            if state["messages"]:
+                state["messages"].pop()
+            else:
+                state["pops"] += 1
+        elif op == "clear":
+            state["cleared"] = True
+        elif op == "snapshot":
+            state["uid"] = record.get("uid") or state["uid"]
+            state["started_at"] = record.get("started_at") or state["started_at"]
+            state["pops"] += record.get("pops", 0)
+            state["messages"].extend(record["messages"])
+            state["cleared"] = state["cleared"] or record.get("cleared", False)
+    return states
+
+class TranscriptLog:
+    """依日期分檔的append-only逐字稿日誌"""
+    
+    def __init__(self, directory: str, fsync_interval: float = 1.0, replay_days: int = 1, retention_days: int = 0):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.replay_days = replay_days
+        self.retention_days = retention_days
+        self._file: Optional[IO[str]] = None
+        self._day: Optional[date] = None
+        # 目前檔案對應日期的結束時間（epoch），寫入時以此判斷是否換日
+        self._day_end = 0.0
+        # 換日後等待fsync與關閉的舊檔案
+        self._retired: List[IO[str]] = []
+        self._dirty = False
+        self._flusher: Optional[asyncio.Task] = None
+        os.makedirs(directory, exist_ok=True)
+    
+    def path_for(self, day: date) -> str:
+        return os.path.join(self.directory, f"{_FILE_PREFIX}{day.isoformat()}{_FILE_SUFFIX}")
+    
+    def _day_files(self) -> List[Tuple[date, str]]:
+        """依日期排序的日誌檔"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.startswith(_FILE_PREFIX) and name.endswith(_FILE_SUFFIX):
+                try:
+                    day = date.fromisoformat(name[len(_FILE_PREFIX):-len(_FILE_SUFFIX)])
+                except ValueError:
+                    continue
+                files.append((day, os.path.join(self.directory, name)))
+        return sorted(files)
+    
+    def log_start(self, session: Session):
+        self._write({"op": "start", "sid": session.session_id, "uid": session.user_id, "ts": session.started_at})
+    
+    def log_message(self, session_id: str, role: Role, content: str, timestamp: float):
+        self._write({"op": "msg", "sid": session_id, "role": int(role), "content": content, "ts": timestamp})
+    
+    def log_pop(self, session_id: str):
+        self._write({"op": "pop", "sid": session_id})
+    
+    def log_clear(self, session_id: str):
+        self._write({"op": "clear", "sid": session_id})
+    
+    def _write(self, record: Dict):
+        started = time.perf_counter()
+        now = time.time()
+        if self._file is None or now >= self._day_end:
+            self._open_day(now)
+        self._file.write(_dumps(record))
+        if self.fsync_interval <= 0:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        else:
+            self._dirty = True
+            self._ensure_flusher()
+        metrics.observe("transcript.append_us", (time.perf_counter() - started) * 1_000_000)
+    
+    def _open_day(self, now: float):
+        """開啟（或換日時切換到）當日的日誌檔"""
+        day = date.fromtimestamp(now)
+        if self._file is not None:
+            # 舊檔案在背景fsync後關閉，避免阻塞事件迴圈
+            self._file.flush()
+            self._retired.append(self._file)
+        self._file = open(self.path_for(day), "a", encoding="utf-8")
+        self._day = day
+        self._day_end = datetime.combine(day + timedelta(days=1), datetime.min.time()).timestamp()
+    
+    def _ensure_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            try:
+                self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+            except RuntimeError:
+                # 沒有事件迴圈（例如同步腳本），直接寫入磁碟
+                self.flush()
+    
+    async def _flush_loop(self):
+        """定期批次fsync；換日後在背景壓縮過去的日誌"""
+        compacted_day = None
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            if self._dirty or self._retired:
+                started = time.perf_counter()
+                self._dirty = False
+                self._file.flush()
+                retired, self._retired = self._retired, []
+                await asyncio.to_thread(self._sync, [self._file] + retired)
+                metrics.observe("transcript.fsync_ms", (time.perf_counter() - started) * 1000)
+            if compacted_day != self._day:
+                compacted_day = self._day
+                await asyncio.to_thread(self.compact)
+    
+    @staticmethod
+    def _sync(files: List[IO[str]]):
+        for i, f in enumerate(files):
+            os.fsync(f.fileno())
+            if i > 0:
+                f.close()
+    
+    def flush(self):
+        """同步寫入磁碟（關閉服務時呼叫）"""
+        for f in self._retired:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        self._retired = []
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._dirty = False
+    
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    def _read_states(self, path: str) -> Dict[str, Dict]:
+        with open(path, "r", encoding="utf-8") as f:
+            return _reduce(f, os.path.basename(path))
+    
+    def replay(self) -> Dict[str, Session]:
+        """依序重播近期（今天與前replay_days天）的日誌，回傳未被清除的session"""
+        cutoff = date.today() - timedelta(days=self.replay_days)
+        sessions: Dict[str, Session] = {}
+        for day, path in self._day_files():
+            if day < cutoff:
+                continue
+            for session_id, state in self._read_states(path).items():
+                session = sessions.get(session_id)
+                if session is None:
+                    if state["uid"] is None:
+                        # session開始於重播範圍之前，視為已結束
+                        continue
+                    session = sessions[session_id] = Session(session_id, state["uid"], state["started_at"])
+                for _ in range(min(state["pops"], len(session))):
+                    session.pop()
+                for role, content, timestamp in state["messages"]:
+                    session.append(Role(role), content, timestamp)
+                if state["cleared"]:
+                    del sessions[session_id]
+        # 重啟前發出的ETag不應與重播後的版本相符
+        revision = time.time_ns()
+        for session in sessions.values():
+            session.revision = revision
+        logger.info("逐字稿重播完成", extra={"sessions": len(sessions)})
+        return sessions
+    
+    def compact(self):
+        """將過去日期的日誌整理為每個session一行，並刪除超過保存期限的日誌"""
+        today = self._day or date.today()
+        for day, path in self._day_files():
+            if self.retention_days > 0 and day < today - timedelta(days=self.retention_days):
+                os.remove(path)
+                metrics.inc("transcript.files_expired")
+                continue
+            if day >= today:
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                if f.readline() == _COMPACTED_HEADER:
+                    continue
+            self._compact_file(path)
+    
+    def _compact_file(self, path: str):
+        started = time.perf_counter()
+        before = os.path.getsize(path)
+        states = self._read_states(path)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(_COMPACTED_HEADER)
+            for session_id, state in states.items():
+                record = {"op": "snapshot", "sid": session_id, "messages": state["messages"]}
+                if state["uid"] is not None:
+                    record["uid"] = state["uid"]
+                    record["started_at"] = state["started_at"]
+                if state["pops"]:
+                    record["pops"] = state["pops"]
+                if state["cleared"]:
+                    record["cleared"] = True
+                f.write(_dumps(record))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        metrics.inc("transcript.files_compacted")
+        logger.info("逐字稿日誌壓縮完成", extra={
+            "file": os.path.basename(path),
+            "sessions": len(states),
+            "bytes_before": before,
+            "bytes_after": os.path.getsize(path),
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        })
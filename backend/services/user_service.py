@@ -1,14 +1,80 @@
+import asyncio
 import json
 import os
+import time
 from datetime import datetime
-from typing import Dict, List, Optional
-from models.profile import User, CompleteProfile, UserContainer
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from pydantic_core import to_jsonable_python
+from config import settings
+from logger import get_logger
+from models.profile import User, CompleteProfile
+from .hot_reload import file_signature
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # orjson屬於perf選用依賴，未安裝時使用標準庫
+    _json_loads = json.loads
+
+logger = get_logger(__name__)
+
+_datetime_adapter = TypeAdapter(datetime)
+
+def _record_name(record: Any) -> str:
+    """從User或尚未驗證的原始dict取出姓名"""
+    if isinstance(record, User):
+        return record.profile_data.basic_info.name
+    try:
+        return record["profile_data"]["basic_info"]["name"]
+    except (KeyError, TypeError):
+        return ""
+
+def project_user(user: User, fields: List[str]) -> Dict[str, Any]:
+    """只輸出指定的profile欄位（以點分隔路徑，如 basic_info.name），保留與完整資料相同的巢狀結構"""
+    projected: Dict[str, Any] = {}
+    for path in fields:
+        node: Any = user.profile_data
+        target = projected
+        parts = path.split(".")
+        for depth, part in enumerate(parts):
+            if not isinstance(node, BaseModel) or part not in type(node).model_fields:
+                raise ValueError(f"未知的欄位: {path}")
+            node = getattr(node, part)
+            if depth == len(parts) - 1:
+                target[part] = to_jsonable_python(node)
+            else:
+                target = target.setdefault(part, {})
+    
+    return {
+        "id": user.id,
+        "profile_data": projected,
+        "created_at": user.created_at.isoformat(),
+        "updated_at": user.updated_at.isoformat(),
+    }
 
 class UserService:
-    def __init__(self, users_file: str = "data/users.json"):
+    def __init__(self, users_file: str = "data/users.json", lazy: bool = True):
         self.users_file = users_file
+        # lazy模式下啟動時只解析JSON，各用戶在首次存取時才以pydantic驗證
+        self.lazy = lazy
+        # 用戶id -> 已驗證的User，或尚未驗證的原始dict
+        self._records: Dict[str, Any] = {}
+        # 已驗證用戶對應的原始dict，重新載入時用來比對內容是否變動
+        self._sources: Dict[str, Dict[str, Any]] = {}
+        # 重新載入後內容變動但updated_at未變的用戶，驗證時改以載入時間作為新版本，
+        # 讓以updated_at為版本的ETag與各項快取失效
+        self._restamp: Dict[str, datetime] = {}
+        # 用戶id -> 姓名，列表API只讀取此索引，不需走訪完整profile
+        self._name_index: Dict[str, str] = {}
+        # 用戶新增或姓名變動時遞增，用於列表的ETag；以啟動時間起算，重啟後不會與舊ETag重複
+        self.list_revision = time.time_ns()
+        # 最近一次載入或寫入時的檔案簽章，用於判斷檔案是否被外部修改
+        self._file_signature: Optional[Tuple[int, int]] = None
         self._ensure_data_dir()
         self._load_users()
+        self._rebuild_name_index()
     
     def _ensure_data_dir(self):
         """確保data目錄存在"""
@@ -18,55 +84,168 @@ class UserService:
         """從JSON文件載入用戶資料"""
         try:
             if os.path.exists(self.users_file):
-                with open(self.users_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # 手動處理datetime字符串轉換
-                    for user_id, user_data in data.get("users", {}).items():
-                        if "created_at" in user_data and isinstance(user_data["created_at"], str):
-                            user_data["created_at"] = datetime.fromisoformat(user_data["created_at"])
-                        if "updated_at" in user_data and isinstance(user_data["updated_at"], str):
-                            user_data["updated_at"] = datetime.fromisoformat(user_data["updated_at"])
-                    self.users_container = UserContainer(**data)
+                self._file_signature = file_signature(self.users_file)
+                self._records = self._read_records()
+                if not self.lazy:
+                    self._records = {user_id: User.model_validate(record) for user_id, record in self._records.items()}
             else:
                 # 不自動建立用戶，只建立空容器
-                print("警告: users.json 文件不存在，請手動創建用戶資料")
-                self.users_container = UserContainer()
+                logger.warning("users.json 文件不存在，請手動創建用戶資料", extra={"path": self.users_file})
+                self._records = {}
         except Exception as e:
-            print(f"載入用戶資料失敗: {e}")
+            logger.error("載入用戶資料失敗", extra={"error": str(e)})
             # 發生錯誤時也不自動建立，只建立空容器
-            self.users_container = UserContainer()
+            self._records = {}
+    
+    def _read_records(self) -> Dict[str, Any]:
+        """讀取users.json中的原始用戶資料（不驗證）"""
+        with open(self.users_file, 'rb') as f:
+            data = _json_loads(f.read())
+        return dict(data.get("users", {}))
+    
+    async def reload_if_changed(self) -> bool:
+        """users.json被外部修改時重新載入
+        
+        只替換內容有變動的用戶，未變動的用戶沿用已驗證的物件；新資料組好後一次替換，
+        讀取中的請求不會看到半套資料。回傳是否有變動
+        """
+        signature = file_signature(self.users_file)
+        if signature is None or signature == self._file_signature:
+            return False
+        
+        records = await asyncio.to_thread(self._read_records)
+        if file_signature(self.users_file) != signature:
+            # 讀取期間檔案又被修改，下次輪詢再處理
+            return False
+        self._file_signature = signature
+        
+        current = self._records
+        merged: Dict[str, Any] = {}
+        changed: List[str] = []
+        for user_id, record in records.items():
+            existing = current.get(user_id)
+            if existing is not None and self._same_record(user_id, existing, record):
+                merged[user_id] = existing
+            else:
+                merged[user_id] = record
+                changed.append(user_id)
+                if existing is not None and self._updated_at(existing) == self._updated_at(record):
+                    self._restamp[user_id] = datetime.now()
+        removed = [user_id for user_id in current if user_id not in records]
+        if not changed and not removed:
+            return False
+        
+        self._records = merged
+        for user_id in changed + removed:
+            self._sources.pop(user_id, None)
+        for user_id in removed:
+            self._restamp.pop(user_id, None)
+        self._rebuild_name_index()
+        if not self.lazy:
+            for user_id in changed:
+                self.get_user(user_id)
+        logger.info("users.json已重新載入", extra={"changed": changed, "removed": removed})
+        return True
+    
+    @staticmethod
+    def _updated_at(record: Any) -> Optional[datetime]:
+        """User或原始dict的updated_at，原始資料無法解析時回傳None"""
+        if isinstance(record, User):
+            return record.updated_at
+        try:
+            return _datetime_adapter.validate_python(record.get("updated_at"))
+        except (ValidationError, AttributeError):
+            return None
+    
+    def _same_record(self, user_id: str, existing: Any, record: Dict[str, Any]) -> bool:
+        """比對記憶體中的用戶與檔案中的原始資料是否相同"""
+        if not isinstance(existing, User):
+            return existing == record
+        source = self._sources.get(user_id)
+        if source is None:
+            # 由本服務建立或更新的用戶，檔案內容即為model_dump的結果
+            return existing.model_dump(mode='json') == record
+        return source == record
     
     def _save_users(self):
         """儲存用戶資料到JSON文件"""
         try:
+            # 尚未驗證的用戶直接寫回原始資料
+            data = {
+                "users": {
+                    user_id: record.model_dump(mode='json') if isinstance(record, User) else record
+                    for user_id, record in self._records.items()
+                }
+            }
             with open(self.users_file, 'w', encoding='utf-8') as f:
-                # 使用model_dump()來處理datetime序列化
-                data = self.users_container.model_dump(mode='json')
                 json.dump(data, f, ensure_ascii=False, indent=2)
+            # 自己寫入的變更不需要再重新載入
+            self._file_signature = file_signature(self.users_file)
+            # 已驗證用戶在檔案中的內容已是model_dump的結果，之後改以此比對
+            self._sources.clear()
         except Exception as e:
-            print(f"儲存用戶資料失敗: {e}")
+            logger.error("儲存用戶資料失敗", extra={"error": str(e)})
+    
+    def _rebuild_name_index(self):
+        self._name_index = {
+            user_id: _record_name(record)
+            for user_id, record in self._records.items()
+        }
+        self.list_revision += 1
+    
+    def _index_user(self, user: User):
+        name = user.profile_data.basic_info.name
+        if self._name_index.get(user.id) != name:
+            self._name_index[user.id] = name
+            self.list_revision += 1
     
     # 移除_create_demo_user方法，不自動建立示範用戶
     
     def get_all_users(self) -> Dict[str, User]:
-        """獲取所有用戶字典"""
-        return self.users_container.users
+        """獲取所有用戶字典（會驗證所有尚未驗證的用戶）"""
+        users = {}
+        for user_id in list(self._records):
+            user = self.get_user(user_id)
+            if user is not None:
+                users[user_id] = user
+        return users
     
-    def get_all_users_list(self) -> List[Dict[str, str]]:
-        """獲取所有用戶列表（用於API響應）"""
-        return [
-            {"id": user_id, "name": user.profile_data.basic_info.name}
-            for user_id, user in self.users_container.users.items()
-        ]
+    def get_all_users_list(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, str]]:
+        """獲取用戶列表（用於API響應），可分頁"""
+        items = list(self._name_index.items())
+        stop = None if limit is None else offset + limit
+        return [{"id": user_id, "name": name} for user_id, name in items[offset:stop]]
+    
+    def get_user_name(self, user_id: str) -> Optional[str]:
+        """用戶名稱，不需驗證完整profile；用戶不存在時回傳None"""
+        return self._name_index.get(user_id)
+    
+    def count_users(self) -> int:
+        """用戶總數"""
+        return len(self._name_index)
     
     def get_user(self, user_id: str) -> Optional[User]:
-        """獲取特定用戶"""
-        return self.users_container.users.get(user_id)
+        """獲取特定用戶，首次存取時驗證並快取"""
+        record = self._records.get(user_id)
+        if record is None or isinstance(record, User):
+            return record
+        
+        try:
+            user = User.model_validate(record)
+        except ValidationError as e:
+            logger.error("用戶資料驗證失敗", extra={"record_user_id": user_id, "error": str(e)})
+            return None
+        stamp = self._restamp.pop(user_id, None)
+        if stamp is not None:
+            user.updated_at = stamp
+        self._records[user_id] = user
+        self._sources[user_id] = record
+        return user
     
     def create_user(self, profile_data: CompleteProfile) -> User:
         """創建新用戶"""
         # 生成新的用戶ID
-        max_id = max([int(uid) for uid in self.users_container.users.keys()], default=0)
+        max_id = max([int(uid) for uid in self._records.keys()], default=0)
         new_id = str(max_id + 1)
         
         new_user = User(
@@ -76,21 +255,31 @@ class UserService:
             updated_at=datetime.now()
         )
         
-        self.users_container.users[new_id] = new_user
+        self._records[new_id] = new_user
+        self._index_user(new_user)
         self._save_users()
         return new_user
     
     def update_user(self, user_id: str, profile_data: CompleteProfile) -> Optional[User]:
         """更新用戶資料"""
-        if user_id not in self.users_container.users:
+        if user_id not in self._records:
             return None
         
-        user = self.users_container.users[user_id]
+        user = self.get_user(user_id)
+        if user is None:
+            # 原始資料驗證失敗時以新的profile取代
+            user = User(id=user_id, profile_data=profile_data, created_at=datetime.now(), updated_at=datetime.now())
+            self._records[user_id] = user
         user.profile_data = profile_data
         user.updated_at = datetime.now()
+        self._sources.pop(user_id, None)
+        self._restamp.pop(user_id, None)
+        self._index_user(user)
         
         self._save_users()
         return user
 
-# 全局用戶服務實例
-user_service = UserService()
+@lru_cache
+def get_user_service() -> UserService:
+    """取得全局用戶服務實例（首次使用時才載入users.json）"""
+    return UserService(settings.users_data_file, lazy=settings.users_lazy_validation)
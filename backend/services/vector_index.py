@@ -0,0 +1,377 @@
+import os
+import numpy as np
+from typing import List, Dict, Optional, Tuple
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 支援的儲存精度
+# float16沒有對應的BLAS內積，分塊還原後評分約比float32慢一個數量級，記憶體只省一半，不如int8
+STORAGE_DTYPES = ("float32", "int8")
+
+# 量化儲存時每次還原成float32計算的列數；小區塊可留在CPU快取內，比一次還原整個矩陣快
+_SCORE_CHUNK = 256
+
+def normalize_vector(vector) -> np.ndarray:
+    """轉為float32並正規化為單位向量，之後cosine相似度只需一次內積"""
+    vec = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm > 0 else vec
+
+class VectorIndex:
+    """記憶體內的正規化向量矩陣，支援單一用戶評分與矩陣-向量批次搜尋
+    
+    dtype可選float32或int8（每列一個縮放係數的純量量化），評分直接在量化後的資料上進行；
+    dimensions大於0時只保留前dimensions維並重新正規化（text-embedding-3系列支援Matryoshka截斷）
+    """
+    
+    def __init__(self, dtype: str = "float32", dimensions: int = 0):
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(f"不支援的向量儲存精度: {dtype}")
+        self.dtype = dtype
+        self.dimensions = dimensions
+        self.ids: List[str] = []
+        self.positions: Dict[str, int] = {}
+        self.texts: Dict[str, str] = {}
+        # 預留容量的緩衝區，新增向量時攤銷成長，避免每次新增都複製整個矩陣
+        self._buffer: Optional[np.ndarray] = None
+        # int8模式下每列的縮放係數
+        self._scale_buffer: Optional[np.ndarray] = None
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    @property
+    def matrix(self) -> Optional[np.ndarray]:
+        """目前所有向量組成的矩陣（緩衝區的view，為儲存精度的原始資料）"""
+        if self._buffer is None:
+            return None
+        return self._buffer[:len(self.ids)]
+    
+    @matrix.setter
+    def matrix(self, value: Optional[np.ndarray]):
+        self._buffer = value
+    
+    @property
+    def scales(self) -> Optional[np.ndarray]:
+        if self._scale_buffer is None:
+            return None
+        return self._scale_buffer[:len(self.ids)]
+    
+    @scales.setter
+    def scales(self, value: Optional[np.ndarray]):
+        self._scale_buffer = value
+    
+    @property
+    def nbytes(self) -> int:
+        """向量資料佔用的記憶體（不含預留容量）"""
+        if self._buffer is None:
+            return 0
+        size = self.matrix.nbytes
+        if self._scale_buffer is not None:
+            size += self.scales.nbytes
+        return size
+    
+    def prepare(self, vector) -> np.ndarray:
+        """正規化，並依設定截斷維度後重新正規化；寫入與查詢都經過此步驟"""
+        vec = normalize_vector(vector)
+        if self.dimensions and vec.shape[0] > self.dimensions:
+            vec = normalize_vector(vec[:self.dimensions])
+        return vec
+    
+    def _encode(self, vec: np.ndarray) -> Tuple[np.ndarray, float]:
+        if self.dtype == "int8":
+            scale = float(np.abs(vec).max()) / 127 or 1.0
+            return np.round(vec / scale).astype(np.int8), scale
+        return vec.astype(self.dtype), 1.0
+    
+    def decode(self, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """將全部（或指定列）向量還原為float32"""
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        decoded = matrix.astype(np.float32)
+        if self.dtype == "int8":
+            scales = self.scales if rows is None else self.scales[rows]
+            decoded *= scales[:, None]
+        return decoded
+    
+    def _scores(self, query_vec: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """計算全部（或指定列）向量與query的內積；量化儲存時分塊還原以限制暫存記憶體"""
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        if self.dtype == "float32":
+            return matrix @ query_vec
+        
+        scores = np.empty(len(matrix), dtype=np.float32)
+        buffer = np.empty((min(_SCORE_CHUNK, len(matrix)), matrix.shape[1]), dtype=np.float32)
+        for start in range(0, len(matrix), _SCORE_CHUNK):
+            chunk = matrix[start:start + _SCORE_CHUNK]
+            decoded = buffer[:len(chunk)]
+            np.copyto(decoded, chunk, casting="unsafe")
+            scores[start:start + len(chunk)] = decoded @ query_vec
+        if self.dtype == "int8":
+            scores *= self.scales if rows is None else self.scales[rows]
+        return scores
+    
+    def _grow(self, capacity: int):
+        grown = np.empty((capacity, self._buffer.shape[1]), dtype=self._buffer.dtype)
+        grown[:len(self.ids)] = self.matrix
+        self._buffer = grown
+        if self._scale_buffer is not None:
+            scales = np.ones(capacity, dtype=np.float32)
+            scales[:len(self.ids)] = self.scales
+            self._scale_buffer = scales
+    
+    def upsert(self, user_id: str, vector, profile_text: str):
+        """新增或更新一筆向量（寫入時即正規化並量化）"""
+        vec = self.prepare(vector)
+        if vec.size == 0:
+            return
+        if self._buffer is None:
+            self._buffer = np.empty((16, vec.shape[0]), dtype=self.dtype)
+            if self.dtype == "int8":
+                self._scale_buffer = np.ones(16, dtype=np.float32)
+        elif vec.shape[0] != self._buffer.shape[1]:
+            logger.warning("向量維度不符，略過", extra={"vector_user_id": user_id, "dim": int(vec.shape[0])})
+            return
+        self.texts[user_id] = profile_text
+        
+        position = self.positions.get(user_id)
+        if position is None:
+            position = len(self.ids)
+            if position == len(self._buffer):
+                self._grow(2 * len(self._buffer))
+            self.positions[user_id] = position
+            self.ids.append(user_id)
+        self._buffer[position], scale = self._encode(vec)
+        if self._scale_buffer is not None:
+            self._scale_buffer[position] = scale
+    
+    def remove(self, user_id: str):
+        """移除一筆向量（以最後一筆補位）"""
+        position = self.positions.pop(user_id, None)
+        self.texts.pop(user_id, None)
+        if position is None:
+            return
+        last = len(self.ids) - 1
+        if position != last:
+            moved = self.ids[last]
+            self.ids[position] = moved
+            self.positions[moved] = position
+            self._buffer[position] = self._buffer[last]
+            if self._scale_buffer is not None:
+                self._scale_buffer[position] = self._scale_buffer[last]
+        self.ids.pop()
+    
+    def copy(self) -> "VectorIndex":
+        """複製索引，用於在副本上更新後整體替換"""
+        clone = VectorIndex(self.dtype, self.dimensions)
+        self._copy_into(clone)
+        return clone
+    
+    def _copy_into(self, clone: "VectorIndex"):
+        clone.ids = list(self.ids)
+        clone.positions = dict(self.positions)
+        clone.texts = dict(self.texts)
+        clone.matrix = None if self.matrix is None else self.matrix.copy()
+        clone.scales = None if self.scales is None else self.scales.copy()
+    
+    def score(self, query_vec: np.ndarray, user_id: str) -> float:
+        """單一用戶的cosine相似度（兩個單位向量的內積）"""
+        position = self.positions.get(user_id)
+        if position is None:
+            return 0.0
+        return float(self.decode(np.array([position]))[0] @ self.prepare(query_vec))
+    
+    def search(self, query_vec: np.ndarray, top_k: int = 5) -> List[Tuple[str, float]]:
+        """對所有向量做一次矩陣-向量乘法，回傳最相似的前top_k筆"""
+        if not self.ids:
+            return []
+        scores = self._scores(self.prepare(query_vec))
+        top_k = min(top_k, len(self.ids))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[i], float(scores[i])) for i in top]
+
+def _spherical_kmeans(data: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    """以cosine相似度分群的k-means，回傳正規化後的群中心"""
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(data @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        # 空群以隨機樣本重新初始化
+        sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.maximum(norms, 1e-12)
+    return centroids.astype(np.float32)
+
+class IVFIndex(VectorIndex):
+    """倒排檔（IVF）近似最近鄰索引
+    
+    以k-means將向量分成nlist群，搜尋時只比對與query最接近的nprobe群；
+    向量數未達min_train_size或尚未訓練時退回精確搜尋。新增的向量直接分配到最近的群，
+    資料量成長到訓練時的兩倍後由呼叫端觸發重新訓練。
+    """
+    
+    def __init__(
+        self,
+        nlist: int = 0,
+        nprobe: int = 16,
+        min_train_size: int = 1000,
+        dtype: str = "float32",
+        dimensions: int = 0
+    ):
+        super().__init__(dtype, dimensions)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.centroids: Optional[np.ndarray] = None
+        # 每一列向量所屬的群，與矩陣列位置對齊；-1表示尚未分配
+        self._codes: Optional[np.ndarray] = None
+        self.trained_size = 0
+    
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+    
+    @property
+    def codes(self) -> np.ndarray:
+        return self._codes[:len(self)] if self._codes is not None else np.zeros(0, dtype=np.int32)
+    
+    def needs_training(self) -> bool:
+        if len(self) < self.min_train_size:
+            return False
+        return not self.trained or len(self) >= 2 * self.trained_size
+    
+    def train(self, iterations: int = 10, max_samples_per_list: int = 64, seed: int = 0):
+        """以目前的向量訓練群中心並重新分配所有向量"""
+        nlist = self.nlist or max(1, int(np.sqrt(len(self))))
+        nlist = min(nlist, len(self))
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(self), nlist * max_samples_per_list)
+        sample = self.decode(rng.choice(len(self), sample_size, replace=False))
+        centroids = _spherical_kmeans(sample, nlist, iterations, rng)
+        
+        codes = np.full(len(self._buffer), -1, dtype=np.int32)
+        # 分批分配，避免一次建立 n × nlist 的大矩陣
+        for start in range(0, len(self), 4096):
+            stop = min(start + 4096, len(self))
+            codes[start:stop] = np.argmax(self.decode(np.arange(start, stop)) @ centroids.T, axis=1)
+        self.centroids, self._codes = centroids, codes
+        self.trained_size = len(self)
+        logger.info("IVF索引訓練完成", extra={"vectors": len(self), "nlist": nlist})
+    
+    def maybe_train(self) -> bool:
+        """資料量足夠且尚未訓練（或已大幅成長）時訓練，回傳是否有訓練"""
+        if not self.needs_training():
+            return False
+        self.train()
+        return True
+    
+    def upsert(self, user_id: str, vector, profile_text: str):
+        super().upsert(user_id, vector, profile_text)
+        position = self.positions.get(user_id)
+        if position is None:
+            return
+        if self._codes is None or len(self._codes) < len(self._buffer):
+            grown = np.full(len(self._buffer), -1, dtype=np.int32)
+            if self._codes is not None:
+                grown[:len(self._codes)] = self._codes
+            self._codes = grown
+        if self.trained:
+            self._codes[position] = int(np.argmax(self.centroids @ self.decode(np.array([position]))[0]))
+        else:
+            self._codes[position] = -1
+    
+    def remove(self, user_id: str):
+        position = self.positions.get(user_id)
+        last = len(self) - 1
+        super().remove(user_id)
+        if position is not None and position != last and self._codes is not None:
+            self._codes[position] = self._codes[last]
+    
+    def copy(self) -> "IVFIndex":
+        clone = IVFIndex(self.nlist, self.nprobe, self.min_train_size, self.dtype, self.dimensions)
+        self._copy_into(clone)
+        clone.centroids = self.centroids
+        clone._codes = self.codes.copy() if self._codes is not None else None
+        clone.trained_size = self.trained_size
+        return clone
+    
+    def search(self, query_vec: np.ndarray, top_k: int = 5) -> List[Tuple[str, float]]:
+        """只在最接近query的nprobe群內做精確比對"""
+        if not self.trained:
+            return super().search(query_vec, top_k)
+        
+        query_vec = self.prepare(query_vec)
+        nprobe = min(self.nprobe, len(self.centroids))
+        probe = np.argpartition(-(self.centroids @ query_vec), nprobe - 1)[:nprobe]
+        candidates = np.flatnonzero(np.isin(self.codes, probe))
+        if candidates.size == 0:
+            return []
+        if candidates.size * 2 > len(self):
+            # 候選超過一半時，取出子矩陣的成本反而高於全部比對
+            return super().search(query_vec, top_k)
+        
+        scores = self._scores(query_vec, candidates)
+        top_k = min(top_k, candidates.size)
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[candidates[i]], float(scores[i])) for i in top]
+    
+    def save(self, path: str, source_signature: Optional[Tuple[int, int]]):
+        """將向量、群中心與分配結果存成npz，source_signature用於判斷vectors.json是否已更新"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                ids=np.array(self.ids, dtype=str),
+                texts=np.array([self.texts.get(user_id, "") for user_id in self.ids], dtype=str),
+                matrix=self.matrix if self.matrix is not None else np.zeros((0, 0), dtype=self.dtype),
+                scales=self.scales if self.scales is not None else np.zeros(0, dtype=np.float32),
+                storage=np.array([self.dtype, str(self.dimensions)]),
+                centroids=self.centroids if self.centroids is not None else np.zeros((0, 0), dtype=np.float32),
+                codes=self.codes,
+                trained_size=np.array(self.trained_size),
+                source_signature=np.array(source_signature or (0, 0), dtype=np.int64),
+            )
+        os.replace(tmp_path, path)
+    
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        source_signature: Optional[Tuple[int, int]],
+        nlist: int = 0,
+        nprobe: int = 16,
+        min_train_size: int = 1000,
+        dtype: str = "float32",
+        dimensions: int = 0
+    ) -> Optional["IVFIndex"]:
+        """載入已儲存的索引；檔案不存在、與目前的vectors.json不一致或儲存設定不同時回傳None"""
+        if source_signature is None or not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if tuple(int(x) for x in data["source_signature"]) != tuple(source_signature):
+                    return None
+                if "storage" not in data or list(data["storage"]) != [dtype, str(dimensions)]:
+                    return None
+                index = cls(nlist, nprobe, min_train_size, dtype, dimensions)
+                index.ids = [str(user_id) for user_id in data["ids"]]
+                index.positions = {user_id: i for i, user_id in enumerate(index.ids)}
+                index.texts = {user_id: str(text) for user_id, text in zip(index.ids, data["texts"])}
+                if index.ids:
+                    index.matrix = data["matrix"]
+                    if data["scales"].size:
+                        index.scales = data["scales"]
+                    index._codes = data["codes"].astype(np.int32)
+                if data["centroids"].size:
+                    index.centroids = data["centroids"]
+                index.trained_size = int(data["trained_size"])
+                return index
+        except Exception as e:
+            logger.error("載入向量索引失敗", extra={"path": path, "error": str(e)})
+            return None